@@ -0,0 +1,393 @@
+import argparse
+import gc
+import io
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+from utils import check_python_version, get_files
+
+
+def benchmark_parse(args):
+    """Parses the html files with every backend, prints the throughput and the fields the backends disagree on."""
+    from parsing import UCLParser
+
+    files = get_files(args.website_dir, '.html')[:args.limit]
+    fields = ['url', 'title', 'description', 'keywords', 'content', 'links_out']
+    results = {}
+
+    for backend in UCLParser.BACKENDS:
+        start_time = time.time()
+        results[backend] = [UCLParser.parse_file(file, backend) for file in files]
+        time_taken = time.time() - start_time
+        print('{:>5}: {} files in {:.3f} seconds ({:.1f} files/s)'.format(backend, len(files), time_taken,
+                                                                         len(files) / time_taken if time_taken else 0))
+
+    mismatches = 0
+    for file, bs4_doc, lxml_doc in zip(files, results[UCLParser.BACKEND_BS4], results[UCLParser.BACKEND_LXML]):
+        if bs4_doc is None or lxml_doc is None:
+            if bs4_doc is not lxml_doc:
+                mismatches += 1
+                print('Mismatch in %s: parsed by only one backend' % file)
+            continue
+        for field in fields:
+            if getattr(bs4_doc, field) != getattr(lxml_doc, field):
+                mismatches += 1
+                print('Mismatch in %s: %s' % (file, field))
+    print('Documents with mismatching fields: %d' % mismatches)
+
+
+class DictDocument(object):
+    """The plain Document class used before the slotted one, kept for comparison."""
+
+    def __init__(self, **kwargs):
+        self.path = kwargs.get('path', None)
+        self.url = kwargs.get('url', None)
+        self.title = kwargs.get('title', '')
+        self.description = kwargs.get('description', '')
+        self.keywords = kwargs.get('keywords', '')
+        self.content = kwargs.get('content', '')
+        self.links_out = kwargs.get('links_out', [])
+        self.links_in = kwargs.get('links_in', [])
+        self.links_in_keywords = kwargs.get('links_in_keywords', '')
+        self.pagerank = kwargs.get('pagerank', 1.0)
+
+
+def generate_doc_kwargs(n, links_per_doc=20, seed=0):
+    """Yields the fields of n synthetic documents. Every string is built separately, like it would be by the parser."""
+    rng = random.Random(seed)
+    words = ['exam', 'timetable', 'moodle', 'programme', 'computer', 'science', 'research', 'student', 'ucl']
+    for i in range(n):
+        links = [('www.cs.ucl.ac.uk/page/%d' % rng.randrange(n), ' '.join(rng.sample(words, 2)))
+                 for _ in range(links_per_doc)]
+        yield {'path': '/mirror/page/%d.html' % i, 'url': 'www.cs.ucl.ac.uk/page/%d' % i,
+               'title': 'Page %d' % i, 'content': ' '.join(rng.choice(words) for _ in range(300)),
+               'links_out': links, 'links_in': list(links)}
+
+
+def measure_docs_memory(doc_class, n, links_per_doc):
+    gc.collect()
+    tracemalloc.start()
+    docs = [doc_class(**kwargs) for kwargs in generate_doc_kwargs(n, links_per_doc)]
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del docs
+    return current
+
+
+def benchmark_memory(args):
+    """Compares the memory held by documents of the plain and of the slotted Document class."""
+    from parsing import Document
+
+    for name, doc_class in [('dict', DictDocument), ('slotted', Document)]:
+        size = measure_docs_memory(doc_class, args.docs, args.links)
+        print('{:>7}: {} documents take {:.1f} MB ({:.0f} bytes per document)'.format(name, args.docs, size / 2 ** 20,
+                                                                                      size / args.docs))
+
+
+def create_legacy_schema():
+    """The schema used before the text of a field was tokenized once for both its plain and its stemmed field."""
+    from whoosh.analysis import StemmingAnalyzer
+    from whoosh.fields import Schema, ID, TEXT, KEYWORD, NUMERIC
+
+    stemming_analyzer = StemmingAnalyzer(cachesize=-1)
+    return Schema(url=ID(stored=True, unique=True),
+                  path=ID(stored=True, unique=True),
+                  title=TEXT(stored=True),
+                  title_stem=TEXT(analyzer=stemming_analyzer),
+                  description=TEXT(),
+                  description_stem=TEXT(analyzer=stemming_analyzer),
+                  keywords=KEYWORD(),
+                  keywords_stem=KEYWORD(analyzer=stemming_analyzer),
+                  links_in_keywords=KEYWORD(),
+                  links_in_keywords_stem=KEYWORD(analyzer=stemming_analyzer),
+                  content=TEXT(),
+                  content_stem=TEXT(analyzer=stemming_analyzer),
+                  pagerank=NUMERIC(stored=True, sortable=True),
+                  signature=ID(stored=True))
+
+
+def generate_docs(n, seed=0):
+    from parsing import Document
+
+    return [Document(**kwargs) for kwargs in generate_doc_kwargs(n, links_per_doc=0, seed=seed)]
+
+
+def time_indexing(schema, docs, index_dir):
+    from whoosh import index
+    from searching import get_fields
+
+    ix = index.create_in(index_dir, schema=schema)
+    start_time = time.time()
+    writer = ix.writer(limitmb=256)
+    for doc in docs:
+        writer.add_document(**{name: value for name, value in get_fields(doc).items() if name in schema})
+    writer.commit()
+    return time.time() - start_time, ix
+
+
+def benchmark_index(args):
+    """Compares the indexing throughput of the legacy and the current schema on a synthetic corpus."""
+    import searching
+
+    docs = generate_docs(args.docs)
+    total_mb = sum(len(doc.content.encode('utf-8')) + len(doc.title) for doc in docs) / 2 ** 20
+    terms = {}
+    for name, schema in [('legacy', create_legacy_schema()), ('current', searching.schema)]:
+        index_dir = tempfile.mkdtemp()
+        try:
+            time_taken, ix = time_indexing(schema, docs, index_dir)
+            with ix.reader() as reader:
+                terms[name] = sorted((fieldname, text, reader.doc_frequency(fieldname, text))
+                                     for fieldname, text in reader.all_terms())
+            ix.close()
+        finally:
+            shutil.rmtree(index_dir)
+        print('{:>7}: {} documents in {:.3f} seconds ({:.1f} docs/s, {:.2f} MB/s)'.format(
+            name, len(docs), time_taken, len(docs) / time_taken, total_mb / time_taken))
+    print('Identical terms and document frequencies: %s' % (terms['legacy'] == terms['current']))
+
+
+BENCHMARK_QUERIES = ['exam timetable', 'moodle', 'syllabus', 'UCL societies', 'data mining', 'programming', 'unix',
+                     'research projects', 'password change', 'undergraduate programme']
+
+
+def print_latencies(name, latencies):
+    latencies = sorted(latencies)
+    print('{:>9}: {} queries, mean {:.2f} ms, p50 {:.2f} ms, p95 {:.2f} ms'.format(
+        name, len(latencies), 1000 * sum(latencies) / len(latencies), 1000 * latencies[len(latencies) // 2],
+        1000 * latencies[int(len(latencies) * 0.95)]))
+
+
+def benchmark_searchers(args):
+    """
+    Compares the per-query latency of opening a searcher for every query with reusing the pooled searchers. An index
+    split into search shards is searched one shard after the other.
+    """
+    from searching import SearchEngine
+
+    se = SearchEngine()
+    queries = [se.qp.parse(query) for query in BENCHMARK_QUERIES] * args.repeat
+    weighting = se.scorers_dict[args.ranking]
+
+    def per_call(q):
+        total = 0
+        for searchers in se.shards:
+            with searchers.ix.searcher(weighting=weighting) as s:
+                total += len(s.search(q, limit=args.limit))
+        return total
+
+    def pooled(q):
+        total = 0
+        for searchers in se.shards:
+            with searchers.searcher(args.ranking) as s:
+                total += len(s.search(q, limit=args.limit))
+        return total
+
+    for name, fn in [('per call', per_call), ('pooled', pooled)]:
+        latencies = []
+        for q in queries:
+            start_time = time.time()
+            fn(q)
+            latencies.append(time.time() - start_time)
+        print_latencies(name, latencies)
+    se.close()
+
+
+# Search engine of the worker processes of benchmark_batch, inherited from the parent process
+batch_search_engine = None
+
+
+def batch_search(query, limit, ranking):
+    return query, ranking, batch_search_engine.search(query, limit, ranking, fields=('url',))
+
+
+def benchmark_batch(args):
+    """
+    Compares the throughput of searching queries x rankings by fanning them out to worker processes (the way
+    evaluate_rankings used to), one after the other, and with SearchEngine.search_many.
+    """
+    global batch_search_engine
+    from searching import SearchEngine
+    from utils import process_batch
+
+    # the result cache would answer every repeated query
+    batch_search_engine = se = SearchEngine(cache_size=0)
+    rankings = [SearchEngine.BM25, SearchEngine.TF_IDF, SearchEngine.PAGERANK, SearchEngine.CUSTOM]
+    queries = ['%s %d' % (query, i) for i in range(args.repeat) for query in BENCHMARK_QUERIES]
+    total = len(queries) * len(rankings)
+
+    def processes():
+        process_batch([(query, args.limit, ranking) for query in queries for ranking in rankings], batch_search)
+
+    def serial():
+        for query in queries:
+            for ranking in rankings:
+                se.search(query, args.limit, ranking, fields=('url',))
+
+    def threads():
+        se.search_many(queries, rankings, args.limit, workers=args.workers)
+
+    for name, fn in [('processes', processes), ('serial', serial), ('threads', threads)]:
+        start_time = time.time()
+        fn()
+        time_taken = time.time() - start_time
+        print('{:>9}: {} searches in {:.3f} seconds ({:.1f} searches/s)'.format(name, total, time_taken,
+                                                                              total / time_taken))
+    se.close()
+
+
+def benchmark_server(args):
+    """Load tests the search server on localhost with concurrent clients, each sending requests one after the other."""
+    import http.client
+    import json
+    import threading
+    from urllib.parse import quote
+    from search_server import create_server
+
+    server = create_server('127.0.0.1', 0, args.workers, args.max_pending, args.deadline_ms)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    host, port = server.server_address[:2]
+
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def client(client_no):
+        connection = http.client.HTTPConnection(host, port)
+        for i in range(args.requests):
+            # distinct queries, so they aren't answered by the result cache
+            query = '%s %d' % (BENCHMARK_QUERIES[(client_no + i) % len(BENCHMARK_QUERIES)], client_no * args.requests + i)
+            start_time = time.time()
+            connection.request('GET', '/search?q=%s&ranking=%s' % (quote(query), args.ranking))
+            response = connection.getresponse()
+            response.read()
+            with lock:
+                latencies.append(time.time() - start_time)
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+        connection.close()
+
+    clients = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    start_time = time.time()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    time_taken = time.time() - start_time
+
+    connection = http.client.HTTPConnection(host, port)
+    connection.request('GET', '/metrics')
+    metrics = json.loads(connection.getresponse().read().decode('utf-8'))
+    server.shutdown()
+    server.server_close()
+    server.service.close()
+
+    print('{} clients: {} requests in {:.3f} seconds ({:.1f} requests/s), statuses: {}'.format(
+        args.clients, len(latencies), time_taken, len(latencies) / time_taken, statuses))
+    print_latencies('latency', latencies)
+    print('server metrics: %s' % json.dumps(metrics))
+
+
+def benchmark_shards(args):
+    """
+    Compares the query latency of a synthetic index split into 1, 2, 4 and 8 search shards, and checks that the
+    sharded indexes score the documents like the unsharded one.
+    """
+    import searching
+
+    rng = random.Random(0)
+    docs = generate_docs(args.docs)
+    for doc in docs:
+        doc.pagerank = rng.random()
+    words = ['exam', 'timetable', 'moodle', 'programme', 'computer', 'science', 'research', 'student', 'ucl']
+    queries = [' '.join(rng.sample(words, rng.randint(1, 3))) for _ in range(10)] * args.repeat
+
+    base_dir = searching.INDEX_BASE_DIR
+    scores = {}
+    try:
+        for search_shards in args.shards:
+            searching.INDEX_BASE_DIR = tempfile.mkdtemp()
+            try:
+                # the progress of the indexing is not part of the benchmark
+                with redirect_stdout(io.StringIO()):
+                    searching.index_documents(docs, search_shards=search_shards)
+                se = searching.SearchEngine(cache_size=0)
+                latencies = []
+                shard_scores = []
+                for query in queries:
+                    start_time = time.time()
+                    hits = se.search(query, args.limit, args.ranking, fields=('url',))
+                    latencies.append(time.time() - start_time)
+                    shard_scores.append([round(hit.score, 6) for hit in hits])
+                se.close()
+            finally:
+                shutil.rmtree(searching.INDEX_BASE_DIR)
+            scores[search_shards] = shard_scores
+            print_latencies('%d shards' % search_shards, latencies)
+    finally:
+        searching.INDEX_BASE_DIR = base_dir
+    # documents with equal scores may be ranked in another order, but the scores must be the same
+    print('Same scores as %d shard(s): %s' % (args.shards[0], all(shard_scores == scores[args.shards[0]]
+                                                                 for shard_scores in scores.values())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the parsing and searching components.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    parse_parser = subparsers.add_parser('parse', help='compare the parsing backends (speed and parity)')
+    parse_parser.add_argument('website_dir', metavar='WEBSITE_DIRECTORY', help='path to directory containing website files')
+    parse_parser.add_argument('-limit', type=int, default=None, help='maximum number of files to parse')
+    parse_parser.set_defaults(fn=benchmark_parse)
+
+    memory_parser = subparsers.add_parser('memory', help='compare the memory used by the Document classes')
+    memory_parser.add_argument('-docs', type=int, default=100000, help='number of synthetic documents')
+    memory_parser.add_argument('-links', type=int, default=20, help='number of links out and in per document')
+    memory_parser.set_defaults(fn=benchmark_memory)
+
+    index_parser = subparsers.add_parser('index', help='compare the indexing throughput of the legacy and current schema')
+    index_parser.add_argument('-docs', type=int, default=5000, help='number of synthetic documents')
+    index_parser.set_defaults(fn=benchmark_index)
+
+    searchers_parser = subparsers.add_parser('searchers', help='compare per-query and pooled searchers (needs an index)')
+    searchers_parser.add_argument('-ranking', default='bm25', help='ranking whose weighting is used')
+    searchers_parser.add_argument('-limit', type=int, default=10, help='number of results per query')
+    searchers_parser.add_argument('-repeat', type=int, default=20, help='number of times every query is run')
+    searchers_parser.set_defaults(fn=benchmark_searchers)
+
+    batch_parser = subparsers.add_parser('batch', help='compare ways of running many searches (needs an index)')
+    batch_parser.add_argument('-limit', type=int, default=10, help='number of results per search')
+    batch_parser.add_argument('-repeat', type=int, default=5, help='number of variants of every query')
+    batch_parser.add_argument('-workers', type=int, default=None, help='number of threads of search_many')
+    batch_parser.set_defaults(fn=benchmark_batch)
+
+    server_parser = subparsers.add_parser('server', help='load test the search server on localhost (needs an index)')
+    server_parser.add_argument('-clients', type=int, default=8, help='number of concurrent clients')
+    server_parser.add_argument('-requests', type=int, default=50, help='number of requests per client')
+    server_parser.add_argument('-ranking', default='custom', help='ranking of the searches')
+    server_parser.add_argument('-workers', type=int, default=None, help='number of search threads of the server')
+    server_parser.add_argument('-max_pending', type=int, default=None, help='admission limit of the server')
+    server_parser.add_argument('-deadline_ms', type=float, default=2000, help='time limit of every request')
+    server_parser.set_defaults(fn=benchmark_server)
+
+    shards_parser = subparsers.add_parser('shards', help='compare the query latency of 1 to 8 search shards')
+    shards_parser.add_argument('-docs', type=int, default=5000, help='number of synthetic documents')
+    shards_parser.add_argument('-shards', type=int, nargs='+', default=[1, 2, 4, 8], help='numbers of search shards')
+    shards_parser.add_argument('-ranking', default='custom', help='ranking of the searches')
+    shards_parser.add_argument('-limit', type=int, default=10, help='number of results per query')
+    shards_parser.add_argument('-repeat', type=int, default=5, help='number of times every query is run')
+    shards_parser.set_defaults(fn=benchmark_shards)
+
+    args = parser.parse_args()
+    args.fn(args)
+
+
+check_python_version()
+
+if __name__ == "__main__":
+    main()
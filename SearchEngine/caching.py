@@ -0,0 +1,228 @@
+import gzip
+import logging
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def atomic_write(path, data):
+    """Writes data (bytes) to path through a temporary file and a rename, so path is never left half written."""
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    try:
+        with open(tmp_path, 'wb') as handle:
+            handle.write(data)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def atomic_pickle_dump(obj, path):
+    atomic_write(path, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+class ShardedDocsCache(object):
+    """
+    Cache of parsed documents split into shards of shard_size documents, with an index file listing the shards.
+
+    Each write uses a fresh set of shard files and only switches to them by atomically replacing the index, so a
+    crash during a write leaves the previous cache intact. Iterating over the cache streams the documents shard by
+    shard; the next shards are read (and decompressed) by background threads while the current one is consumed.
+    """
+    INDEX_FILE = 'index.pickle'
+
+    def __init__(self, path, shard_size=1000, compress=True, readahead=2):
+        self.path = path
+        self.shard_size = shard_size
+        self.compress = compress
+        self.readahead = max(1, readahead)
+        self._index = None
+
+    @property
+    def index_file(self):
+        return os.path.join(self.path, ShardedDocsCache.INDEX_FILE)
+
+    @property
+    def index(self):
+        if self._index is None:
+            with open(self.index_file, 'rb') as handle:
+                self._index = pickle.load(handle)
+        return self._index
+
+    def write(self, docs, metadata=None):
+        """
+        Writes the documents of any iterable, holding at most one shard of them in memory at a time. The metadata
+        dict (e.g. the settings the documents were built with) is kept in the index.
+        """
+        writer = self.writer(metadata)
+        for doc in docs:
+            writer.add(doc)
+        writer.commit()
+
+    def writer(self, metadata=None):
+        """Returns a DocsCacheWriter, to write documents added one at a time."""
+        return DocsCacheWriter(self, metadata)
+
+    def partition(self, n):
+        """Splits the cache into (at most) n caches over disjoint sets of its shards, e.g. to be read by n workers."""
+        partitions = []
+        shards = self.index['shards']
+        for i in range(min(n, len(shards))):
+            partition = ShardedDocsCache(self.path, self.shard_size, self.compress, self.readahead)
+            partition_shards = shards[i::n]
+            partition._index = dict(self.index, shards=partition_shards, total_docs=None)
+            partitions.append(partition)
+        return partitions
+
+    @property
+    def metadata(self):
+        return self.index.get('metadata', {})
+
+    def __len__(self):
+        if self.index['total_docs'] is None:
+            # the number of documents of a partition is only known once it has been read
+            return sum(len(shard) for shard in self.iter_shards())
+        return self.index['total_docs']
+
+    def _read_shard(self, shard_file):
+        with open(os.path.join(self.path, shard_file), 'rb') as handle:
+            data = handle.read()
+        # zlib releases the GIL, so decompression in the readahead threads runs in parallel
+        if self.index['compressed']:
+            data = gzip.decompress(data)
+        return data
+
+    def iter_shards(self):
+        """Yields the documents of the cache one shard (list of documents) at a time."""
+        shards = self.index['shards']
+        with ThreadPoolExecutor(max_workers=self.readahead) as executor:
+            pending = [executor.submit(self._read_shard, shard) for shard in shards[:self.readahead]]
+            for i in range(len(shards)):
+                data = pending.pop(0).result()
+                if i + self.readahead < len(shards):
+                    pending.append(executor.submit(self._read_shard, shards[i + self.readahead]))
+                yield pickle.loads(data)
+
+    def __iter__(self):
+        for shard in self.iter_shards():
+            for doc in shard:
+                yield doc
+
+    def load(self):
+        """Returns all the documents as a list."""
+        return [doc for doc in self]
+
+
+class DocsCacheWriter(object):
+    """
+    Writes the documents added to it to a ShardedDocsCache, holding at most one shard of them in memory at a time.
+    The cache only switches to the new documents on commit.
+    """
+
+    def __init__(self, cache, metadata=None):
+        self.cache = cache
+        self.metadata = metadata or {}
+        self.write_id = uuid.uuid4().hex[:8]
+        self.shards = []
+        self.total_docs = 0
+        self._shard_docs = []
+        if not os.path.isdir(cache.path):
+            os.makedirs(cache.path)
+
+    def add(self, doc):
+        self._shard_docs.append(doc)
+        self.total_docs += 1
+        if len(self._shard_docs) >= self.cache.shard_size:
+            self._write_shard()
+
+    def _write_shard(self):
+        cache = self.cache
+        shard_file = 'shard-%s-%05d.pickle%s' % (self.write_id, len(self.shards), '.gz' if cache.compress else '')
+        data = pickle.dumps(self._shard_docs, protocol=pickle.HIGHEST_PROTOCOL)
+        if cache.compress:
+            data = gzip.compress(data, compresslevel=1)
+        atomic_write(os.path.join(cache.path, shard_file), data)
+        self.shards.append(shard_file)
+        self._shard_docs = []
+
+    def commit(self):
+        if self._shard_docs:
+            self._write_shard()
+        cache = self.cache
+        try:
+            with open(cache.index_file, 'rb') as handle:
+                old_shards = pickle.load(handle)['shards']
+        except Exception:
+            old_shards = []
+        cache._index = {'total_docs': self.total_docs, 'shards': self.shards, 'compressed': cache.compress,
+                        'metadata': self.metadata}
+        atomic_pickle_dump(cache._index, cache.index_file)
+
+        # Only remove the shards of the replaced index once the new one is in place. Shards of other writes aren't
+        # touched, they may belong to a concurrent writer.
+        for file in old_shards:
+            if file not in self.shards:
+                try:
+                    os.unlink(os.path.join(cache.path, file))
+                except OSError:
+                    pass
+
+
+class LRUCache(object):
+    """
+    Thread-safe mapping of at most max_size entries, which evicts the least recently used entry when full and
+    treats entries older than ttl seconds (if ttl is not None) as missing. Counts hits, misses and evictions.
+    """
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[1] > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'expirations': self.expirations}
@@ -1,7 +1,7 @@
 from __future__ import division
 import os
 from searching import SearchEngine
-from utils import check_python_version, process_batch, read_csv, write_csv
+from utils import check_python_version, read_csv, write_csv
 from math import log
 
 check_python_version()
@@ -25,16 +25,14 @@ SEARCH_LIMIT = 10
 se = SearchEngine()
 
 
-# Useful for multithreaded implementation; also adds relevances to documents
-def search_wrapper(query, SEARCH_LIMIT, ranking, relevancies):
-    results = se.search(query, SEARCH_LIMIT, ranking)
+def add_relevancies(query, results, relevancies):
     results_with_relevancies = []
     for result in results:
         relevance = -1
         if (query, result.url) in relevancies:
             relevance = relevancies[(query, result.url)]
         results_with_relevancies.append((result, relevance))
-    return query, ranking, results_with_relevancies
+    return results_with_relevancies
 
 
 def get_user_relevancies(file):
@@ -57,14 +55,8 @@ def get_search_results_with_relevancies(user_relevancies=None):
     print("Generating search results...")
     # document list with relevances (search results) for each (query, algorithm) pair
     results = {
-        (query, algo): results
-        for query, algo, results in process_batch(
-        [
-            (query, SEARCH_LIMIT, algo, user_relevancies)
-            for query in queries for algo in algorithms
-            ],
-        search_wrapper
-    )
+        (query, algo): add_relevancies(query, results, user_relevancies)
+        for (query, algo), results in se.search_many(queries, algorithms, SEARCH_LIMIT).items()
         }
     return results
 
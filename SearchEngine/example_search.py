@@ -25,7 +25,7 @@ config_logging()
 query = "ucl home"
 
 se = searching.SearchEngine()
-search_results = se.search(query, limit=10, ranking=searching.SearchEngine.CUSTOM)
+search_results = se.search(query, limit=10, ranking=searching.SearchEngine.CUSTOM, fields=('url',))
 
 print('Total results: %d' % len(search_results))
 for rank, doc in enumerate(search_results):
@@ -36,7 +36,7 @@ for query in queries:
 
     for algo in algorithms:
 
-        search_results = se.search(query, limit=SEARCH_LIMIT, ranking=algo)
+        search_results = se.search(query, limit=SEARCH_LIMIT, ranking=algo, fields=('url', 'title', 'description'))
 
         for rank, doc in enumerate(search_results):
 
@@ -45,7 +45,7 @@ for query in queries:
             if url not in store[query]:
                 store[query][url] = {}
                 store[query][url]['title'] = doc.title
-                store[query][url]['desc'] = doc.description
+                store[query][url]['desc'] = doc.description or ''
                 for i in algorithms:
                     store[query][url][i] = 0
 
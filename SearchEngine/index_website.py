@@ -10,7 +10,7 @@ import datetime
 import parsing
 import searching
 
-from utils import check_python_version
+from utils import check_python_version, configure_worker_pool
 
 
 def config_logging(debug=False):
@@ -45,14 +45,44 @@ def main():
     parser.add_argument('-debug', action='store_const',
                         const=True, default=False,
                         help='debugging mode (creates detailed logs in log directory)')
+    parser.add_argument('-backend', action='store', choices=parsing.UCLParser.BACKENDS,
+                        default=parsing.UCLParser.BACKEND_BS4,
+                        help='html extraction backend (default: %(default)s)')
+    parser.add_argument('-workers', action='store', type=int, default=None,
+                        help='number of worker processes (default: number of cpus)')
+    parser.add_argument('-chunksize', action='store', type=int, default=None,
+                        help='number of items sent to a worker at once (default: chosen from the batch size)')
+    parser.add_argument('-keep_duplicates', action='store_const', const=True, default=False,
+                        help='do not collapse pages with (nearly) the same content into one document')
+    parser.add_argument('-incremental', action='store_const', const=True, default=False,
+                        help='only add, update and delete the documents which changed since the index was built')
+    parser.add_argument('-stream', action='store_const', const=True, default=False,
+                        help='stream the parsed documents to the index with bounded memory (ignores the docs cache)')
+    parser.add_argument('-index_shards', action='store', type=int, default=1,
+                        help='number of worker processes building index segments in parallel (default: %(default)s)')
+    parser.add_argument('-index_limitmb', action='store', type=int, default=256,
+                        help='memory budget of each index writer process in MB (default: %(default)s)')
+    parser.add_argument('-index_merge', action='store_const', const=True, default=False,
+                        help='merge the segments built by -index_shards workers into a single segment')
+    parser.add_argument('-search_shards', action='store', type=int, default=1,
+                        help='number of sub-indexes the documents are split into by url hash, searched concurrently '
+                             '(default: %(default)s)')
     parser.add_argument('website_dir', metavar='WEBSITE_DIRECTORY', action='store', type=lambda dir: is_valid_dir(parser, dir),
                         help='path to directory containing website files')
 
     args = parser.parse_args()
     config_logging(args.debug)
+    configure_worker_pool(args.workers, args.chunksize)
 
-    docs = parsing.UCLParser.parse_website(args.website_dir, use_cache=True, multithreading=not args.debug)
-    searching.index_docs(docs)
+    if args.stream:
+        docs = parsing.UCLParser.parse_website_streaming(args.website_dir, backend=args.backend,
+                                                         remove_near_duplicates=not args.keep_duplicates)
+    else:
+        docs = parsing.UCLParser.parse_website(args.website_dir, use_cache=True, multithreading=not args.debug,
+                                               backend=args.backend, lazy=True,
+                                               remove_near_duplicates=not args.keep_duplicates)
+    searching.index_docs(docs, incremental=args.incremental, shards=args.index_shards, limitmb=args.index_limitmb,
+                         merge=args.index_merge, search_shards=args.search_shards)
 
 
 check_python_version()
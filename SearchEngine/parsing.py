@@ -1,8 +1,13 @@
 
+import codecs
+import hashlib
 import logging
+import multiprocessing
 import os
 import pickle
 import re
+import shutil
+from array import array
 
 logger = logging.getLogger(__name__)
 
@@ -15,11 +20,21 @@ except ImportError as e:
 
 try:
     import lxml
+    import lxml.html
+    from lxml import etree
 except ImportError as e:
     logger.error('Error: %s.\n%s\n%s', str(e), 'lxml must be installed to proceed.', 'Command to install missing library: pip install lxml')
     exit(1)
 
-from utils import print_progress, profile, MSG_START, MSG_SUCCESS, MSG_FAILED, get_files, process_batch
+try:
+    import numpy as np
+except ImportError as e:
+    logger.error('Error: %s.\n%s\n%s', str(e), 'numpy must be installed to proceed.', 'Command to install missing library: pip install numpy')
+    exit(1)
+
+from caching import ShardedDocsCache, atomic_pickle_dump
+from utils import print_progress, profile, MSG_START, MSG_SUCCESS, MSG_FAILED, get_files, process_batch, \
+    get_worker_pool, SizedIterable
 
 
 docs_cache_dir = 'docs_cache/'
@@ -28,93 +43,304 @@ docs_cache_dir = 'docs_cache/'
 class UCLParser(object):
     PARSER = 'lxml'
 
+    BACKEND_BS4 = 'bs4'
+    BACKEND_LXML = 'lxml'
+    BACKENDS = [BACKEND_BS4, BACKEND_LXML]
+
+    SKIPPED_CONTENT_TAGS = {'br', 'script', 'style', 'iframe'}
+
     NO_INDEX_COMMENT = 'noindex'
     NO_INDEX_END_COMMENT = 'endnoindex'
     PAGE_HAS_MOVED_TITLE = 'Page has moved'
 
+    # The HTTrack header and <meta charset> are looked for in the first bytes of the file only
+    HEADER_SCAN_BYTES = 8192
+    MIRRORED_FROM_REGEX = re.compile(b'(?<=<!-- Mirrored from )(.*)(?= by HTTrack Website Copier)')
+    META_CHARSET_REGEX = re.compile(b'<meta[^>]+charset\\s*=\\s*["\']?\\s*([A-Za-z0-9_.:-]+)', re.IGNORECASE)
+    BOMS = [(codecs.BOM_UTF8, 'utf-8'), (codecs.BOM_UTF16_LE, 'utf-16-le'), (codecs.BOM_UTF16_BE, 'utf-16-be')]
+    DEFAULT_ENCODING = 'utf-8'
+
+    SIMHASH_MIN_TOKENS = 20
+    SIMHASH_SHINGLE_SIZE = 3
+    SIMHASH_MAX_DISTANCE = 3
+
     @staticmethod
     @profile
-    def parse_website(dir, use_cache=False, multithreading=True):
+    def parse_website(dir, use_cache=False, multithreading=True, backend=BACKEND_BS4, lazy=False,
+                      remove_near_duplicates=True):
+        """
+        Returns the parsed documents of the website.
+        With lazy=True, documents read from the cache are streamed from disk instead of being loaded into a list.
+        With remove_near_duplicates=True, pages with (nearly) the same content are collapsed into one document.
+        """
         msg = "Parsing website"
         logger.info('%s %s', MSG_START, msg)
-        logger.info("From directory %s", dir)
+        logger.info("From directory %s using %s backend", dir, backend)
+        Document.reset_string_table()
 
         if not os.path.isdir(dir):
             logger.error('ERROR: Directory %s does not exist!', dir)
             logger.info('%s %s', MSG_FAILED, msg)
             exit()
 
-        pickle_file = docs_cache_dir + re.sub('/|:|\\\\', '', dir) + '.pickle'
-        loaded_from_cache = False
+        cache_name = re.sub('/|:|\\\\', '', dir)
+        docs_cache = ShardedDocsCache(docs_cache_dir + cache_name)
+        # The documents as parse_file returned them, before the link stages modify them, to be reused for the files
+        # which didn't change
+        parsed_cache = ShardedDocsCache(docs_cache_dir + cache_name + '.parsed')
+        manifest_file = docs_cache_dir + cache_name + '.manifest.pickle'
 
         docs = []
 
-        if use_cache:
-            # Read docs from cache
+        logger.info("Getting file paths...")
+        files = get_files(dir, '.html')
+        logger.info("Found %d html files", len(files))
+
+        manifest = UCLParser.load_manifest(manifest_file) if use_cache else {}
+        manifest, files_to_parse, removed = UCLParser.diff_manifest(manifest, files, backend)
+
+        # Settings which change the cached documents even when the files didn't change
+        cache_metadata = {'remove_near_duplicates': remove_near_duplicates}
+        if use_cache and not files_to_parse and not removed:
+            # Nothing changed since the last run, read docs from cache
             try:
-                with open(pickle_file, 'rb') as handle:
-                    docs = pickle.load(handle)
-                    loaded_from_cache = True
-                    logger.info("Loaded %d documents from cache.", len(docs))
-            except Exception:
-                logger.info("No cached documents found")
-
-        if not loaded_from_cache:
-            logger.info("Getting file paths...")
-            files = get_files(dir, '.html')
-            logger.info("Found %d html files", len(files))
-            logger.info("Parsing files...")
-            if multithreading:
-                docs = [doc for doc in process_batch([(file,) for file in files], UCLParser.parse_file) if doc is not None]
-            else:
-                docs = []
-                total_docs = len(files)
-                for i, file in enumerate(files):
-                    doc = UCLParser.parse_file(file)
-                    if doc is not None:
-                        docs.append(doc)
-                    print_progress(i + 1, total_docs, 'Progress:')
-                # docs = [doc for doc in process_batch([(file,) for file in files], UCLParser.parse_file, 1) if doc is not None]
-            logger.info("Successfully parsed %d files", len(docs))
-
-            docs = UCLParser.validate_docs_links_out(docs)
-            # UCLParser.remove_duplicate_docs(docs)
-            docs = UCLParser.add_links_in(docs)
-
-            UCLParser.add_pagerank(docs)
-
-            if not os.path.isdir(docs_cache_dir):
-                os.mkdir(docs_cache_dir)
-            # Cache documents
+                if docs_cache.metadata != cache_metadata:
+                    raise ValueError("the documents were cached with different settings")
+                docs = docs_cache if lazy else docs_cache.load()
+                logger.info("Loaded %d documents from cache.", len(docs))
+                logger.info('%s %s', MSG_SUCCESS, msg)
+                return docs
+            except Exception as e:
+                logger.info("No usable cached documents found: %s", e)
+
+        parsed_docs = {}
+        reused_files = set(file for file in files if manifest[file]['parsed'] and file not in files_to_parse)
+        if reused_files:
             try:
-                with open(pickle_file, 'wb') as handle:
-                    pickle.dump(docs, handle, protocol=pickle.HIGHEST_PROTOCOL)
-                    logger.info("Successfully cached %d documents.", len(docs))
+                for doc in parsed_cache:
+                    if doc.path in reused_files:
+                        parsed_docs[doc.path] = doc
             except Exception as e:
-                logger.info("Failed to cache documents: %s", e)
+                logger.info("Could not read the parsed documents cache: %s", e)
+            # files whose document is missing from the cache are parsed again
+            files_to_parse.extend(file for file in reused_files if file not in parsed_docs)
+
+        logger.info("Parsing files...")
+        if multithreading:
+            parsed = process_batch([(file, backend) for file in files_to_parse], UCLParser.parse_file)
+        else:
+            parsed = []
+            total_docs = len(files_to_parse)
+            for i, file in enumerate(files_to_parse):
+                parsed.append(UCLParser.parse_file(file, backend))
+                print_progress(i + 1, total_docs, 'Progress:')
+
+        for file, doc in zip(files_to_parse, parsed):
+            manifest[file]['parsed'] = doc is not None
+            if doc is not None:
+                parsed_docs[file] = doc
+
+        logger.info("Reused %d files, re-parsed %d files, dropped %d deleted files",
+                    len(files) - len(files_to_parse), len(files_to_parse), removed)
+
+        docs = [parsed_docs[file] for file in files if file in parsed_docs]
+        logger.info("Successfully parsed %d files", len(docs))
+
+        if not os.path.isdir(docs_cache_dir):
+            os.mkdir(docs_cache_dir)
+        # Written before the link stages modify the documents, and before the manifest which refers to them
+        try:
+            parsed_cache.write(docs)
+        except Exception as e:
+            logger.info("Failed to cache parsed documents: %s", e)
+        UCLParser.save_manifest(manifest_file, manifest)
+
+        if remove_near_duplicates:
+            docs, _ = UCLParser.remove_near_duplicate_docs(docs)
+
+        graph = UCLParser.build_link_graph(docs)
+        docs = UCLParser.validate_docs_links_out(docs, graph)
+        # UCLParser.remove_duplicate_docs(docs)
+        docs = UCLParser.add_links_in(docs, graph)
+
+        UCLParser.add_pagerank(docs, graph)
+
+        # Cache documents
+        try:
+            docs_cache.write(docs, cache_metadata)
+            logger.info("Successfully cached %d documents in %d shards.", len(docs), len(docs_cache.index['shards']))
+        except Exception as e:
+            logger.info("Failed to cache documents: %s", e)
 
         logger.info('%s %s', MSG_SUCCESS, msg)
         return docs
 
     @staticmethod
-    def parse_file(file_path_abs):
+    @profile
+    def parse_website_streaming(dir, backend=BACKEND_BS4, max_pending=None, remove_near_duplicates=True):
+        """
+        Parses the website without ever holding all the documents in memory.
+        The parsed documents flow from the worker pool (with at most max_pending chunks in flight) straight into a
+        sharded spill cache, keeping only their links_out for the link graph stages.
+        Returns a lazy iterable which streams the documents back from the spill cache, with links_in,
+        links_in_keywords and pagerank filled in from the link graph, e.g. for searching.index_docs. It can only be
+        read once: the spill cache is deleted once it has been read (or the iteration is abandoned).
+        Memory stays bounded, but parsing and indexing don't overlap: the links_in and pageranks of the documents are
+        only known once every file has been parsed.
+        """
+        msg = "Parsing website (streaming)"
+        logger.info('%s %s', MSG_START, msg)
+        logger.info("From directory %s using %s backend", dir, backend)
+        Document.reset_string_table()
+
+        if not os.path.isdir(dir):
+            logger.error('ERROR: Directory %s does not exist!', dir)
+            logger.info('%s %s', MSG_FAILED, msg)
+            exit()
+
+        logger.info("Getting file paths...")
+        files = get_files(dir, '.html')
+        logger.info("Found %d html files", len(files))
+
+        link_docs = []
+        fingerprints = []
+        sizes = []
+
+        def parsed_docs():
+            results = get_worker_pool().imap_bounded(UCLParser.parse_file, ((file, backend) for file in files),
+                                                     max_pending)
+            for i, doc in enumerate(results):
+                print_progress(i + 1, len(files), 'Parsed')
+                if doc is not None:
+                    link_docs.append(Document(url=doc.url, links_out=doc.links_out))
+                    if remove_near_duplicates:
+                        fingerprints.append(UCLParser.simhash(doc.content))
+                        sizes.append(UCLParser.doc_size(doc))
+                    yield doc
+
+        logger.info("Parsing files...")
+        spill_dir = docs_cache_dir + re.sub('/|:|\\\\', '', dir) + '.stream'
+        # left over by a run which failed or never read its documents
+        shutil.rmtree(spill_dir, ignore_errors=True)
+        spill_cache = ShardedDocsCache(spill_dir)
+        try:
+            spill_cache.write(parsed_docs())
+        except Exception:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+            raise
+        logger.info("Successfully parsed %d files", len(spill_cache))
+
+        aliases = {}
+        if remove_near_duplicates:
+            link_docs, aliases = UCLParser.remove_near_duplicate_docs(link_docs, fingerprints, sizes)
+        total_docs = len(link_docs)
+
+        graph = UCLParser.build_link_graph(link_docs)
+        UCLParser.validate_docs_links_out(link_docs, graph)
+        UCLParser.add_links_in(link_docs, graph)
+        UCLParser.add_pagerank(link_docs, graph)
+        link_docs = {doc.url: doc for doc in link_docs}
+
+        def linked_docs():
+            try:
+                for doc in spill_cache:
+                    if doc.url in aliases:
+                        continue
+                    link_doc = link_docs[doc.url]
+                    doc.links_out = link_doc.links_out
+                    doc.links_in = link_doc.links_in
+                    doc.links_in_keywords = link_doc.links_in_keywords
+                    doc.pagerank = link_doc.pagerank
+                    yield doc
+            finally:
+                shutil.rmtree(spill_dir, ignore_errors=True)
+
+        logger.info('%s %s', MSG_SUCCESS, msg)
+        return SizedIterable(linked_docs(), total_docs)
+
+    @staticmethod
+    def load_manifest(manifest_file):
+        """
+        Returns the manifest saved by the last run, mapping file path to its mtime, size, hash, backend and whether
+        it was parsed into a document (which is then in the parsed documents cache).
+        """
+        try:
+            with open(manifest_file, 'rb') as handle:
+                manifest = pickle.load(handle)
+        except Exception:
+            logger.info("No manifest found")
+            return {}
+        if any('parsed' not in entry for entry in manifest.values()):
+            # manifests used to hold the documents themselves
+            logger.info("Manifest has an old format, ignoring it")
+            return {}
+        logger.info("Loaded manifest with %d files.", len(manifest))
+        return manifest
+
+    @staticmethod
+    def save_manifest(manifest_file, manifest):
+        try:
+            atomic_pickle_dump(manifest, manifest_file)
+            logger.info("Successfully saved manifest with %d files.", len(manifest))
+        except Exception as e:
+            logger.info("Failed to save manifest: %s", e)
+
+    @staticmethod
+    def hash_file(file_path_abs):
+        md5 = hashlib.md5()
+        with open(file_path_abs, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    @staticmethod
+    def diff_manifest(manifest, files, backend=BACKEND_BS4):
+        """
+        Compares the manifest against the files currently on disk.
+        Returns the updated manifest, the files which have to be (re-)parsed and the number of deleted files.
+        Files with a different mtime or size are only re-parsed if their content hash has changed.
+        Files parsed by a different backend are always re-parsed.
+        """
+        new_manifest = {}
+        files_to_parse = []
+
+        for file in files:
+            stat = os.stat(file)
+            entry = manifest.get(file)
+            if entry is not None and entry.get('backend') != backend:
+                entry = None
+            if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                new_manifest[file] = entry
+                continue
+
+            file_hash = UCLParser.hash_file(file)
+            if entry is not None and entry['hash'] == file_hash:
+                entry['mtime'] = stat.st_mtime
+                entry['size'] = stat.st_size
+                new_manifest[file] = entry
+            else:
+                new_manifest[file] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': file_hash, 'backend': backend,
+                                      'parsed': False}
+                files_to_parse.append(file)
+
+        removed = len(set(manifest) - set(new_manifest))
+        return new_manifest, files_to_parse, removed
+
+    @staticmethod
+    def parse_file(file_path_abs, backend=BACKEND_BS4):
         msg = "Parsing file "
         logger.debug('%s %s %s', MSG_START, msg, file_path_abs)
 
         try:
-            try:
-                with open(file_path_abs, 'r') as f:
-                    data = f.read()
-            except UnicodeDecodeError as e:
-                try:
-                    with open(file_path_abs, 'r', encoding='utf-8') as f:
-                        data = f.read()
-                except UnicodeDecodeError as e:
-                    raise e
+            raw, encoding = UCLParser.read_file(file_path_abs)
+            url = UCLParser.extract_url(raw, encoding)
+
+            if backend == UCLParser.BACKEND_LXML:
+                return UCLParser.parse_data_lxml(raw, encoding, url, file_path_abs)
 
+            data = raw.decode(encoding, errors='replace')
             soup = BeautifulSoup(data, UCLParser.PARSER)
             # if UCLParser.check_soup(soup):
-            url = UCLParser.extract_url(data)
 
             if url:
                 doc = Document(path=file_path_abs, url=url)
@@ -131,7 +357,7 @@ class UCLParser(object):
                     doc.content = UCLParser.extract_content(soup)
                 else:
                     doc.links_out = UCLParser.extract_links_out(soup)
-                    doc.links_out = [(link, '') for link in doc.links_out]
+                    doc.links_out = [(link, '') for link, _ in doc.links_out]
                 logger.debug('%s %s', MSG_SUCCESS, msg)
                 return doc
             else:
@@ -141,6 +367,137 @@ class UCLParser(object):
             logger.debug('%s %s', MSG_FAILED, msg)
             return None
 
+    @staticmethod
+    def read_file(file_path_abs):
+        """Reads the file in one go and returns its bytes (without any BOM) and their sniffed encoding."""
+        with open(file_path_abs, 'rb') as f:
+            raw = f.read()
+        return UCLParser.sniff_encoding(raw)
+
+    @staticmethod
+    def sniff_encoding(raw):
+        """Returns (raw without BOM, encoding), taking the encoding from the BOM or else from <meta charset>."""
+        for bom, encoding in UCLParser.BOMS:
+            if raw.startswith(bom):
+                return raw[len(bom):], encoding
+
+        match = UCLParser.META_CHARSET_REGEX.search(raw, 0, UCLParser.HEADER_SCAN_BYTES)
+        if match:
+            try:
+                return raw, codecs.lookup(match.group(1).decode('ascii')).name
+            except LookupError:
+                logger.debug("Unknown charset: %s", match.group(1))
+        return raw, UCLParser.DEFAULT_ENCODING
+
+    @staticmethod
+    def parse_data_lxml(raw, encoding, url, file_path_abs):
+        """Same as the BeautifulSoup path of parse_file, but builds a single lxml tree and walks the body once."""
+        if not url:
+            raise Exception("Url not found!")
+
+        try:
+            # lxml decodes the raw bytes itself
+            root = lxml.html.document_fromstring(raw, parser=lxml.html.HTMLParser(encoding=encoding))
+        except (LookupError, etree.ParserError):
+            root = lxml.html.document_fromstring(raw.decode(encoding, errors='replace').encode('utf-8'),
+                                                 parser=lxml.html.HTMLParser(encoding='utf-8'))
+
+        doc = Document(path=file_path_abs, url=url)
+        title, description, keywords = UCLParser.extract_head_lxml(root)
+        links_out, content = UCLParser.extract_body_lxml(root.find('body'))
+
+        if not title == UCLParser.PAGE_HAS_MOVED_TITLE:
+            doc.title = title
+            doc.description = description
+            doc.keywords = keywords
+            doc.links_out = links_out
+            doc.content = content
+        else:
+            doc.links_out = [(link, '') for link, _ in links_out]
+        return doc
+
+    @staticmethod
+    def extract_head_lxml(root):
+        title = ''
+        title_elem = root.find('.//title')
+        if title_elem is not None:
+            title = UCLParser.clean_text(next(title_elem.itertext(), ''))
+
+        desc_elem = root.find('.//meta[@name="description"]')
+        description = UCLParser.clean_text(desc_elem.get('content', '') if desc_elem is not None else '')
+
+        keywords_elem = root.find('.//meta[@name="keywords"]')
+        keywords = keywords_elem.get('content', '') if keywords_elem is not None else ''
+
+        return title, description, keywords
+
+    @staticmethod
+    def extract_body_lxml(body):
+        """
+        Returns (links_out, content) of the body in a single walk.
+        Text inside noindex/endnoindex comment ranges and br, script, style and iframe elements is left out of the
+        content, but (as with the BeautifulSoup path) still counts towards the anchor texts.
+        """
+        if body is None:
+            return [], ''
+
+        content = []
+        no_index = None  # text seen since an opening noindex comment, dropped once the range is closed
+        a_links = []
+        object_links = []
+        open_anchors = []
+        skip_depth = 0
+
+        def add_text(text, is_comment=False):
+            if not text:
+                return
+            for anchor in open_anchors:
+                anchor[1].append(text)
+            if is_comment or skip_depth:
+                return
+            if no_index is None:
+                content.append(text)
+            else:
+                no_index.append(text)
+
+        for event, elem in etree.iterwalk(body, events=('start', 'end', 'comment', 'pi')):
+            if event in ('comment', 'pi'):
+                if event == 'comment':
+                    add_text(elem.text, is_comment=True)
+                    if elem.text == UCLParser.NO_INDEX_COMMENT and no_index is None:
+                        no_index = []
+                    elif elem.text == UCLParser.NO_INDEX_END_COMMENT and no_index is not None:
+                        no_index = None
+                add_text(elem.tail)
+                continue
+
+            tag = elem.tag
+            if event == 'start':
+                if tag in UCLParser.SKIPPED_CONTENT_TAGS:
+                    skip_depth += 1
+                if tag == 'a' and 'href' in elem.attrib:
+                    anchor = [UCLParser.clean_url(elem.get('href')), []]
+                    a_links.append(anchor)
+                    open_anchors.append(anchor)
+                elif tag == 'object' and 'data' in elem.attrib:
+                    object_links.append((UCLParser.clean_url(elem.get('data')), ''))
+                add_text(elem.text)
+            else:
+                if tag in UCLParser.SKIPPED_CONTENT_TAGS:
+                    skip_depth -= 1
+                if tag == 'a' and 'href' in elem.attrib:
+                    open_anchors.pop()
+                if elem is not body:
+                    add_text(elem.tail)
+
+        if no_index is not None:
+            # an unterminated noindex comment does not hide anything
+            content.extend(no_index)
+
+        links = [(href, UCLParser.clean_text(' '.join(texts))) for href, texts in a_links]
+        links.extend(object_links)
+        return links, UCLParser.clean_text(' '.join(content))
+
     @staticmethod
     def check_soup(soup):
         div_elements = soup.findAll('div')
@@ -160,8 +517,8 @@ class UCLParser(object):
         msg = "Removing non indexable elements "
         logger.debug('%s %s', MSG_START, msg)
 
-        data = re.sub('<!--' + UCLParser.NO_INDEX_COMMENT + '-->(?s).*?<!--' + UCLParser.NO_INDEX_END_COMMENT + '-->',
-                      '', data)
+        data = re.sub('(?s)<!--' + UCLParser.NO_INDEX_COMMENT + '-->.*?<!--' + UCLParser.NO_INDEX_END_COMMENT + '-->',
+                      ' ', data)
 
         logger.debug('%s %s', MSG_SUCCESS, msg)
         return data
@@ -213,14 +570,19 @@ class UCLParser(object):
         return url
 
     @staticmethod
-    def extract_url(data):
+    def extract_url(raw, encoding=DEFAULT_ENCODING):
         msg = 'Extracting url'
         logger.debug('%s %s', MSG_START, msg)
 
-        # url = \
-        #     re.findall("(?<=<!-- Mirrored from )(.*)(?= by HTTrack Website Copier)",
-        #                str(data))[0]
-        url = re.search("(?<=<!-- Mirrored from )(.*)(?= by HTTrack Website Copier)", str(data)).group()
+        url = None
+        header = raw[:UCLParser.HEADER_SCAN_BYTES]
+        if encoding.startswith('utf-16'):
+            # the only sniffed encodings which are not ascii compatible
+            header = raw[:2 * UCLParser.HEADER_SCAN_BYTES].decode(encoding, errors='replace').encode('utf-8')
+            encoding = 'utf-8'
+        match = UCLParser.MIRRORED_FROM_REGEX.search(header)
+        if match:
+            url = match.group().decode(encoding, errors='replace')
         if url:
             url = UCLParser.clean_url(url)
             logger.debug("Url found: %s", url)
@@ -238,8 +600,7 @@ class UCLParser(object):
 
         title = ""
         try:
-            title = soup.find('title').find(text=True)
-            title = UCLParser.clean_text(title)
+            title = UCLParser.clean_text(soup.find('title').find(text=True))
         except Exception as e:
             logger.debug('Could not extract title!')
 
@@ -321,30 +682,135 @@ class UCLParser(object):
         return links
 
     @staticmethod
-    def validate_doc_links_out(doc, internal_urls):
-        msg = "Validating document links_out"
-        # logger.debug('%s %s', MSG_START, msg)
+    @profile
+    def build_link_graph(docs):
+        msg = "Building link graph"
+        logger.info('%s %s', MSG_START, msg)
 
-        doc.links_out[:] = [(link, text) for (link, text) in doc.links_out if link in internal_urls and not link == doc.url]
-        # logger.debug('%s %s', MSG_SUCCESS, msg)
-        return doc
+        graph = LinkGraph(docs)
+
+        logger.info("Nodes: %d, Edges: %d, Documents without links_out: %d", graph.n, len(graph.out_indices),
+                    len(graph.dangling))
+        logger.info('%s %s', MSG_SUCCESS, msg)
+        return graph
 
     @staticmethod
-    def validate_docs_links_out(docs):
+    def validate_docs_links_out(docs, graph=None):
+        """Removes the links_out which point to the document itself or outside of the parsed documents."""
         msg = "Validating documents links_out"
         logger.info('%s %s', MSG_START, msg)
 
-        # path_to_url = {}
-        # for doc in docs:
-        #     path_to_url[doc.path] = doc.url
-        internal_urls = set([doc.url for doc in docs])
-
-        docs = process_batch([(doc, internal_urls) for doc in docs], UCLParser.validate_doc_links_out)
+        internal_urls = graph.url_to_id if graph is not None else set([doc.url for doc in docs])
+        for doc in docs:
+            doc.links_out = [(link, text) for (link, text) in doc.links_out
+                             if link in internal_urls and not link == doc.url]
 
-        # logger.info('Validated unique urls: %d', len(urls))
         logger.info('%s %s', MSG_SUCCESS, msg)
         return docs
 
+    @staticmethod
+    def simhash(text):
+        """
+        Returns the 64 bit SimHash fingerprint of the word shingles of text, or None if the text is too short for
+        its fingerprint to be meaningful. Shingles are hashed with blake2b rather than Python's per-process salted
+        string hash, so fingerprints are stable across runs.
+        """
+        tokens = text.lower().split()
+        if len(tokens) < UCLParser.SIMHASH_MIN_TOKENS:
+            return None
+
+        size = UCLParser.SIMHASH_SHINGLE_SIZE
+        shingles = set(' '.join(tokens[i:i + size]) for i in range(len(tokens) - size + 1))
+        digests = b''.join(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest() for shingle in shingles)
+        bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8)).reshape(-1, 64)
+        majority = bits.sum(axis=0) * 2 > len(shingles)
+        return int.from_bytes(np.packbits(majority).tobytes(), 'big')
+
+    @staticmethod
+    def doc_size(doc):
+        return sum(len(text.encode('utf-8')) for text in (doc.title, doc.description, doc.keywords, doc.content))
+
+    @staticmethod
+    def find_near_duplicates(fingerprints, max_distance=SIMHASH_MAX_DISTANCE):
+        """
+        Returns the clusters (lists of indexes into fingerprints) of fingerprints within max_distance bits of each
+        other. Fingerprints are split into max_distance + 1 bands, and only fingerprints sharing a band are compared:
+        two fingerprints at most max_distance bits apart always agree on at least one band.
+        """
+        by_fingerprint = {}
+        for i, fingerprint in enumerate(fingerprints):
+            if fingerprint is not None:
+                by_fingerprint.setdefault(fingerprint, []).append(i)
+
+        parent = {fingerprint: fingerprint for fingerprint in by_fingerprint}
+
+        def find(fingerprint):
+            while not parent[fingerprint] == fingerprint:
+                parent[fingerprint] = parent[parent[fingerprint]]
+                fingerprint = parent[fingerprint]
+            return fingerprint
+
+        bands = max_distance + 1
+        band_bits = 64 // bands
+        band_mask = (1 << band_bits) - 1
+        for band in range(bands):
+            buckets = {}
+            for fingerprint in by_fingerprint:
+                buckets.setdefault((fingerprint >> (band * band_bits)) & band_mask, []).append(fingerprint)
+            for bucket in buckets.values():
+                for i in range(len(bucket)):
+                    for j in range(i + 1, len(bucket)):
+                        if bin(bucket[i] ^ bucket[j]).count('1') <= max_distance:
+                            parent[find(bucket[i])] = find(bucket[j])
+
+        clusters = {}
+        for fingerprint, indexes in by_fingerprint.items():
+            clusters.setdefault(find(fingerprint), []).extend(indexes)
+        return [sorted(cluster) for cluster in clusters.values() if len(cluster) > 1]
+
+    @staticmethod
+    @profile
+    def remove_near_duplicate_docs(docs, fingerprints=None, sizes=None):
+        """
+        Collapses documents with (nearly) the same content into the one with the shortest url (preferring urls
+        without a query string). The links_out of the removed documents are merged into the canonical document and
+        links to them are redirected to it.
+        fingerprints and sizes are computed from the documents when not given.
+        Returns the remaining documents and a dict mapping every removed url to its canonical url.
+        """
+        msg = "Removing near duplicate documents"
+        logger.info('%s %s', MSG_START, msg)
+
+        if fingerprints is None:
+            fingerprints = [UCLParser.simhash(doc.content) for doc in docs]
+        if sizes is None:
+            sizes = [UCLParser.doc_size(doc) for doc in docs]
+
+        aliases = {}
+        bytes_saved = 0
+        for cluster in UCLParser.find_near_duplicates(fingerprints):
+            canonical = min((docs[i] for i in cluster), key=lambda doc: ('?' in doc.url, len(doc.url), doc.url))
+            links_out = list(canonical.links_out)
+            for i in cluster:
+                doc = docs[i]
+                if not doc.url == canonical.url and doc.url not in aliases:
+                    aliases[doc.url] = canonical.url
+                    links_out.extend(doc.links_out)
+                    bytes_saved += sizes[i]
+            canonical.links_out = links_out
+
+        if aliases:
+            docs = [doc for doc in docs if doc.url not in aliases]
+            for doc in docs:
+                links_out = doc.links_out
+                if any(link in aliases for link, _ in links_out):
+                    doc.links_out = [(aliases.get(link, link), text) for link, text in links_out]
+
+        logger.info("Near duplicate clusters: %d, removed documents: %d, bytes saved: %d",
+                    len(set(aliases.values())), len(aliases), bytes_saved)
+        logger.info('%s %s', MSG_SUCCESS, msg)
+        return docs, aliases
+
     @staticmethod
     def remove_duplicate_docs(docs):
         msg = "Removing duplicate documents"
@@ -369,68 +835,211 @@ class UCLParser(object):
         logger.info('%s %s', MSG_SUCCESS, msg)
 
     @staticmethod
-    def add_links_in(docs):
+    def add_links_in(docs, graph=None):
         msg = 'Adding links_in'
         logger.info('%s %s', MSG_START, msg)
 
-        docs_dict = {doc.url: doc for doc in docs}
-        doc_links_in_keywords = {doc.url: set() for doc in docs}
-
-        for url, doc in docs_dict.items():
-            for link, text in doc.links_out:
-                try:
-                    if not link == url:
-                        docs_dict[link].links_in.append((url, text))
-                        doc_links_in_keywords[url].add(text)
-                except KeyError:
-                    # this shouldn't happen
-                    logger.error("Link not found: %s", link)
-                    pass
-
-        # print("Total docs: " + str(len(docs)))
-        # docs = [doc for doc in docs if len(doc.links_in) > 0]
-        # logger.info("Found docs with incoming links from other docs: %d", len(docs))
-
-        # Fix documents that don't have any links_out
-        for url, doc in docs_dict.items():
-            if len(doc.links_out) == 0:
-                doc.links_out = doc.links_in
-                for link, _ in doc.links_out:
-                    docs_dict[link].links_in.append((url,''))
+        if graph is None:
+            graph = LinkGraph(docs)
+
+        links_in = [graph.links_in(i) for i in range(graph.n)]
+        links_in_keywords = [', '.join([keyword.replace(',', ' ') for keyword in keywords])
+                             for keywords in map(sorted, graph.anchor_texts)]
 
         for doc in docs:
-            if doc.url in doc_links_in_keywords:
-                doc.links_in_keywords = ', '.join([keyword.replace(',', ' ') for keyword in doc_links_in_keywords[doc.url]])
+            i = graph.url_to_id[doc.url]
+            doc.links_in = links_in[i]
+            doc.links_in_keywords = links_in_keywords[i]
+
+        # Documents that don't have any links_out link back to the documents linking to them
+        for i in graph.dangling:
+            links_out = [(graph.urls[src], text) for src, text in graph.original_links_in(i)]
+            for doc in graph.docs[graph.urls[i]]:
+                doc.links_out = links_out
 
         logger.info('%s %s', MSG_SUCCESS, msg)
         return docs
 
     @staticmethod
     @profile
-    def add_pagerank(docs, epochs=30, damping_factor=0.85):
+    def add_pagerank(docs, graph=None, max_iterations=100, damping_factor=0.85, tolerance=1e-6):
         msg = 'Computing pageranks'
         logger.info('%s %s', MSG_START, msg)
-        docs_dict = {doc.url: doc for doc in docs}
 
-        for epoch in range(1, epochs + 1):
-            print_progress(epoch, epochs, 'Epoch')
-            for url, doc in docs_dict.items():
-                interm = 0.0
-                for link_url, link_text in doc.links_in:
-                    doc_in = docs_dict[link_url]
-                    interm += doc_in.pagerank / len(doc_in.links_out)
-                doc.pagerank = (1-damping_factor) + damping_factor*interm
+        if graph is None:
+            graph = LinkGraph(docs)
 
+        src, dst = graph.edges()
+        ranks, iterations, residual = UCLParser.compute_pagerank(src, dst, graph.n, max_iterations, damping_factor,
+                                                                 tolerance)
+        for doc in docs:
+            doc.pagerank = float(ranks[graph.url_to_id[doc.url]])
 
         s = sum([doc.pagerank for doc in docs])
-        logger.info("Total docs: %d, Pagerank sum: %.3f" % (len(docs), s))
+        logger.info("Total docs: %d, Pagerank sum: %.3f, Iterations: %d, Residual: %.2e" % (len(docs), s, iterations,
+                                                                                            residual))
         logger.info('%s %s', MSG_SUCCESS, msg)
+        return iterations, residual
+
+    @staticmethod
+    def compute_pagerank(src, dst, n, max_iterations=100, damping_factor=0.85, tolerance=1e-6):
+        """
+        Power iteration over the edge list src[i] -> dst[i] of a graph with n nodes (duplicate edges add weight).
+        Ranks are scaled to sum to n, so a page without links in gets (1 - damping_factor).
+        The rank of dangling nodes (no links out) is spread evenly over all nodes.
+        Stops once the mean absolute change of a rank drops below tolerance.
+        Returns (ranks, iterations, residual).
+        """
+        if n == 0:
+            return np.zeros(0), 0, 0.0
+
+        out_degree = np.bincount(src, minlength=n).astype(np.float64)
+        dangling = out_degree == 0
+        edge_weights = 1.0 / out_degree[src]
+
+        ranks = np.ones(n)
+        residual = 0.0
+        iteration = 0
+        for iteration in range(1, max_iterations + 1):
+            new_ranks = np.bincount(dst, weights=ranks[src] * edge_weights, minlength=n)
+            new_ranks += ranks[dangling].sum() / n
+            new_ranks = (1 - damping_factor) + damping_factor * new_ranks
+
+            residual = np.abs(new_ranks - ranks).sum() / n
+            ranks = new_ranks
+            if residual < tolerance:
+                break
+
+        return ranks, iteration, float(residual)
+
+
+class LinkGraph(object):
+    """
+    Link graph of the documents over dense integer ids (one id per unique url), built in a single pass over links_out.
+
+    Edges are deduplicated and stored as CSR arrays: the targets of node i are
+    out_indices[out_indptr[i]:out_indptr[i + 1]] and its sources are in_indices[in_indptr[i]:in_indptr[i + 1]],
+    with in_texts holding the anchor text of every in edge. Links to unknown urls and self links are dropped.
+    Nodes without any links out (dangling) get an edge back to every node linking to them.
+    anchor_texts[i] is the set of (non empty) anchor texts of all the links pointing to node i.
+    """
+
+    def __init__(self, docs):
+        self.docs = {}
+        for doc in docs:
+            self.docs.setdefault(doc.url, []).append(doc)
+        self.urls = list(self.docs)
+        self.url_to_id = {url: i for i, url in enumerate(self.urls)}
+        self.n = len(self.urls)
+        self.anchor_texts = [set() for _ in range(self.n)]
+
+        src = []
+        dst = []
+        texts = []
+        for i, url in enumerate(self.urls):
+            # As before, the last document parsed for a url provides its links
+            for link, text in self.docs[url][-1].links_out:
+                j = self.url_to_id.get(link)
+                if j is not None and not j == i:
+                    src.append(i)
+                    dst.append(j)
+                    texts.append(text)
+                    if text:
+                        self.anchor_texts[j].add(text)
+
+        src = np.array(src, dtype=np.int64)
+        dst = np.array(dst, dtype=np.int64)
+        _, first = np.unique(src * self.n + dst, return_index=True)
+        src = src[first]
+        dst = dst[first]
+        texts = [texts[k] for k in first]
+
+        # Keep the edges into the dangling nodes before adding the edges back from them
+        self._set_in_edges(src, dst, texts)
+        self.original_in_indptr = self.in_indptr
+        self.original_in_indices = self.in_indices
+        self.original_in_texts = self.in_texts
+
+        self.dangling = np.flatnonzero(np.bincount(src, minlength=self.n) == 0)
+        is_dangling = np.zeros(self.n, dtype=bool)
+        is_dangling[self.dangling] = True
+        back_edges = is_dangling[dst]
+        if back_edges.any():
+            src, dst = np.concatenate((src, dst[back_edges])), np.concatenate((dst, src[back_edges]))
+            texts = texts + [''] * int(back_edges.sum())
+            self._set_in_edges(src, dst, texts)
+
+        out_order = np.lexsort((dst, src))
+        self.out_indptr = self._indptr(src[out_order])
+        self.out_indices = dst[out_order]
+
+    def _indptr(self, sorted_ids):
+        return np.concatenate(([0], np.cumsum(np.bincount(sorted_ids, minlength=self.n)))).astype(np.int64)
+
+    def _set_in_edges(self, src, dst, texts):
+        in_order = np.lexsort((src, dst))
+        self.in_indptr = self._indptr(dst[in_order])
+        self.in_indices = src[in_order]
+        self.in_texts = [texts[k] for k in in_order]
+
+    def links_in(self, i):
+        """Returns the (url, anchor text) pairs of the links pointing to node i."""
+        start, end = self.in_indptr[i], self.in_indptr[i + 1]
+        return [(self.urls[src], text) for src, text in zip(self.in_indices[start:end], self.in_texts[start:end])]
+
+    def original_links_in(self, i):
+        """Returns the (id, anchor text) pairs of the links pointing to node i, without the dangling node fix-up."""
+        start, end = self.original_in_indptr[i], self.original_in_indptr[i + 1]
+        return list(zip(self.original_in_indices[start:end], self.original_in_texts[start:end]))
+
+    def edges(self):
+        """Returns the (src, dst) edge arrays."""
+        return np.repeat(np.arange(self.n), np.diff(self.out_indptr)), self.out_indices
+
+
+class StringTable(object):
+    """Maps strings to dense integer ids and back, so a string shared by many documents is only stored once."""
+    __slots__ = ('strings', 'ids')
+
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def get_id(self, string):
+        try:
+            return self.ids[string]
+        except KeyError:
+            self.ids[string] = len(self.strings)
+            self.strings.append(string)
+            return self.ids[string]
+
+    def __getitem__(self, i):
+        return self.strings[i]
+
+    def __len__(self):
+        return len(self.strings)
 
 
 class Document(object):
+    """
+    A parsed html page.
+    links_out and links_in are read-only tuples of (url, anchor text) pairs, but are stored as flat arrays of
+    [url id, text id, ...] into the string table shared by the documents of a parse (see reset_string_table). To
+    change them, assign new links. Pickled documents carry the strings themselves, as the ids only make sense within
+    one process.
+    """
+    __slots__ = ('path', 'url', 'title', 'description', 'keywords', 'content', '_links_out', '_links_in',
+                 'links_in_keywords', 'pagerank', '_strings')
+
+    strings = StringTable()
+
     def __init__(self, **kwargs):
+        self._strings = Document.get_string_table()
         self.path = kwargs.get('path', None)
         self.url = kwargs.get('url', None)
+        if self.url is not None:
+            # share the string with the links pointing to this document
+            self.url = self._strings[self._strings.get_id(self.url)]
         self.title = kwargs.get('title', '')
         self.description = kwargs.get('description', '')
         self.keywords = kwargs.get('keywords', '')
@@ -440,6 +1049,61 @@ class Document(object):
         self.links_in_keywords = kwargs.get('links_in_keywords', '')
         self.pagerank = kwargs.get('pagerank', 1.0)
 
+    @staticmethod
+    def get_string_table():
+        """
+        Returns the string table of a new document: the one shared by all documents of the process, except in worker
+        processes. Their documents are only parsed (or indexed) and passed on, so every one of them gets its own table,
+        which goes away with it instead of collecting the strings of every file the worker ever handled.
+        """
+        if multiprocessing.parent_process() is not None:
+            return StringTable()
+        return Document.strings
+
+    @staticmethod
+    def reset_string_table():
+        """
+        Gives the documents created from now on a new shared string table, e.g. for the next parse of a website.
+        Existing documents keep the table they were created with, so the old one goes away with them.
+        """
+        Document.strings = StringTable()
+
+    def _pack_links(self, links):
+        strings = self._strings
+        packed = array('I')
+        for url, text in links:
+            packed.append(strings.get_id(url))
+            packed.append(strings.get_id(text))
+        return packed
+
+    def _unpack_links(self, packed):
+        strings = self._strings.strings
+        return tuple((strings[packed[i]], strings[packed[i + 1]]) for i in range(0, len(packed), 2))
+
+    @property
+    def links_out(self):
+        return self._unpack_links(self._links_out)
+
+    @links_out.setter
+    def links_out(self, links):
+        self._links_out = self._pack_links(links)
+
+    @property
+    def links_in(self):
+        return self._unpack_links(self._links_in)
+
+    @links_in.setter
+    def links_in(self, links):
+        self._links_in = self._pack_links(links)
+
+    def __getstate__(self):
+        return {'path': self.path, 'url': self.url, 'title': self.title, 'description': self.description,
+                'keywords': self.keywords, 'content': self.content, 'links_out': self.links_out,
+                'links_in': self.links_in, 'links_in_keywords': self.links_in_keywords, 'pagerank': self.pagerank}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
     def __str__(self):
         return \
             "Path: {}\n" \
@@ -4,24 +4,15 @@ import searching
 import time
 from utils import check_python_version
 
-SEARCH_LIMIT = 1000000
 DISPLAY_LIMIT = 10
 
 check_python_version()
 
 se = searching.SearchEngine()
 
-def clamp(val, min_val, max_val):
-    return max(min(val, max_val), min_val)
-
-
-def print_search_results_page(page_no, search_results):
-    end = page_no * DISPLAY_LIMIT
-    start = end - DISPLAY_LIMIT
-
-    for rank, doc in enumerate(search_results):
-        if rank in range(start, end):
-            print("%d. %s" % (rank + 1, doc.url))
+def print_search_results_page(result_page):
+    for rank, doc in enumerate(result_page, result_page.offset):
+        print("%d. %s" % (rank + 1, doc.url))
 
 
 def is_valid_ranking(parser, ranking):
@@ -42,18 +33,16 @@ already_explained = False
 while True:
     query = input('\nEnter search query:\n')
     start_time = time.time()
-    search_results = se.search(query, limit=SEARCH_LIMIT, ranking=args.ranking)
+    cursor = se.cursor(query, pagelen=DISPLAY_LIMIT, ranking=args.ranking, fields=('url',))
     end_time = time.time()
     time_taken = end_time - start_time
-    no_of_results = len(search_results)
+    no_of_results = cursor.total
 
     if not no_of_results:
         print('\nYour search did not match any documents ({:.3f} seconds)'.format(time_taken))
     else:
         print('\nFound {} results ({:.3f} seconds)\n'.format(no_of_results, time_taken))
-        total_pages = int(no_of_results / DISPLAY_LIMIT) + 1
-        page = 1
-        print_search_results_page(page, search_results)
+        print_search_results_page(cursor.current)
 
         while True:
             if already_explained:
@@ -63,13 +52,9 @@ while True:
                 already_explained = True
 
             if key == 'n':
-                page += 1
-                page = clamp(page, 1, total_pages)
-                print_search_results_page(page, search_results)
+                print_search_results_page(cursor.next())
             elif key == 'p':
-                page -= 1
-                page = clamp(page, 1, total_pages)
-                print_search_results_page(page, search_results)
+                print_search_results_page(cursor.previous())
             else:
                 break
 
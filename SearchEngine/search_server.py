@@ -0,0 +1,281 @@
+import argparse
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import cpu_count
+from urllib.parse import urlparse, parse_qs
+
+import searching
+from utils import check_python_version
+from whoosh.query import QueryError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_LENGTH = 10
+MAX_PAGE_LENGTH = 100
+DEFAULT_DEADLINE_MS = 2000
+# Time a search is given on top of its deadline to load the hits of its (partial) results before the request fails
+DEADLINE_GRACE_MS = 100
+# Upper bounds (in ms) of the buckets of the latency histogram
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+# Period over which the queries per second are computed
+QPS_WINDOW = 10.0
+
+
+class SearchMetrics(object):
+    """
+    Thread-safe counters of the requests served, per status, and a histogram of their latencies. The time spent
+    parsing queries and searching is also summed separately.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.requests = 0
+        self.statuses = {}
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.latency_total = 0.0
+        self.parse_total = 0.0
+        self.search_total = 0.0
+        self.searched = 0
+        self._recent = deque()
+        self._lock = threading.Lock()
+
+    def record(self, status, latency, parse_time=None, search_time=None):
+        now = time.time()
+        with self._lock:
+            if parse_time is not None:
+                self.searched += 1
+                self.parse_total += parse_time
+                self.search_total += search_time
+            self.requests += 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.latency_buckets[bisect_left(LATENCY_BUCKETS_MS, latency * 1000)] += 1
+            self.latency_total += latency
+            self._recent.append(now)
+            while self._recent and self._recent[0] < now - QPS_WINDOW:
+                self._recent.popleft()
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            while self._recent and self._recent[0] < now - QPS_WINDOW:
+                self._recent.popleft()
+            buckets = [('<=%d' % bound, count) for bound, count in zip(LATENCY_BUCKETS_MS, self.latency_buckets)]
+            buckets.append(('>%d' % LATENCY_BUCKETS_MS[-1], self.latency_buckets[-1]))
+            return {'uptime_s': round(now - self.started, 3),
+                    'requests': self.requests,
+                    'statuses': dict((str(status), count) for status, count in self.statuses.items()),
+                    'qps': round(len(self._recent) / min(QPS_WINDOW, max(now - self.started, 1e-3)), 3),
+                    'latency_ms_mean': round(1000 * self.latency_total / self.requests, 3) if self.requests else 0,
+                    'parse_ms_mean': round(1000 * self.parse_total / self.searched, 3) if self.searched else 0,
+                    'search_ms_mean': round(1000 * self.search_total / self.searched, 3) if self.searched else 0,
+                    'latency_ms_histogram': buckets}
+
+
+class SearchService(object):
+    """
+    Runs searches on a bounded pool of threads sharing one SearchEngine. At most max_pending searches are admitted
+    (running or waiting for a thread) at a time, further ones are rejected right away instead of queueing up.
+    """
+
+    def __init__(self, search_engine, workers=None, max_pending=None):
+        self.search_engine = search_engine
+        self.workers = workers or cpu_count()
+        self.max_pending = max_pending or 4 * self.workers
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.metrics = SearchMetrics()
+        self.rejected = 0
+        self.timed_out = 0
+        self._admission = threading.BoundedSemaphore(self.max_pending)
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def search(self, query, page, pagelen, ranking, deadline_ms, profile_name=None):
+        """
+        Returns the ResultPage for the query, None if it was rejected because too many searches are pending or
+        raises TimeoutError if it took longer than deadline_ms. The search itself stops at the deadline (counting
+        from now, so including the time it waited for a thread) and then returns partial results. Errors of the
+        search are raised as they are.
+        """
+        deadline = time.time() + deadline_ms / 1000.0
+        if not self._admission.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            return None
+        with self._lock:
+            self._pending += 1
+        try:
+            future = self.executor.submit(self._search, query, page, pagelen, ranking, profile_name, deadline)
+        except Exception:
+            self._release()
+            raise
+        # the admission is only given back once the search is done, even if the client stopped waiting for it
+        future.add_done_callback(lambda _: self._release())
+        try:
+            return future.result(timeout=(deadline_ms + DEADLINE_GRACE_MS) / 1000.0)
+        except TimeoutError:
+            with self._lock:
+                self.timed_out += 1
+            raise
+
+    def _search(self, query, page, pagelen, ranking, profile_name, deadline):
+        deadline_ms = max(1000 * (deadline - time.time()), 0.0)
+        return self.search_engine.search_page(query, page, pagelen, ranking, ('url', 'title'), profile_name,
+                                              deadline_ms)
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+        self._admission.release()
+
+    def stats(self):
+        stats = self.metrics.snapshot()
+        with self._lock:
+            stats.update({'workers': self.workers, 'max_pending': self.max_pending, 'pending': self._pending,
+                          'rejected': self.rejected, 'timed_out': self.timed_out})
+        stats['result_cache'] = self.search_engine.result_cache.stats()
+        stats['query_cache'] = self.search_engine.query_cache.stats()
+        stats['deadline'] = self.search_engine.deadline_stats()
+        stats['index_generation'] = self.search_engine.generation
+        return stats
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.search_engine.close()
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves GET /search?q=...&ranking=...&profile=...&page=...&pagelen=...&deadline_ms=..., /metrics and /health as
+    JSON.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        start_time = time.time()
+        url = urlparse(self.path)
+        timings = (None, None)
+        if url.path == '/search':
+            status, body, timings = self.search(parse_qs(url.query))
+        elif url.path == '/metrics':
+            status, body = 200, self.server.service.stats()
+        elif url.path == '/health':
+            status, body = 200, {'status': 'ok'}
+        else:
+            status, body = 404, {'error': 'Not found: %s' % url.path}
+        self.send_json(status, body)
+        if url.path == '/search':
+            self.server.service.metrics.record(status, time.time() - start_time, *timings)
+
+    def search(self, params):
+        """Returns the status, the body and the (parse time, search time) of the search request."""
+        service = self.server.service
+        query = params.get('q', [''])[0].strip()
+        ranking = params.get('ranking', [searching.SearchEngine.CUSTOM])[0]
+        profile = params.get('profile', [searching.DEFAULT_BOOST_PROFILE])[0]
+        no_timings = (None, None)
+        if not query:
+            return 400, {'error': 'Missing query parameter q'}, no_timings
+        if ranking not in service.search_engine.rankings:
+            return 400, {'error': 'Ranking must be one of these: %s' % ', '.join(service.search_engine.rankings)}, \
+                no_timings
+        if profile not in service.search_engine.boost_profiles:
+            return 400, {'error': 'Boost profile must be one of these: %s'
+                                  % ', '.join(service.search_engine.boost_profiles)}, no_timings
+        try:
+            page = int(params.get('page', [1])[0])
+            pagelen = int(params.get('pagelen', [DEFAULT_PAGE_LENGTH])[0])
+            deadline_ms = float(params.get('deadline_ms', [self.server.deadline_ms])[0])
+        except ValueError:
+            return 400, {'error': 'page, pagelen and deadline_ms must be numbers'}, no_timings
+        if page < 1 or not 1 <= pagelen <= MAX_PAGE_LENGTH or deadline_ms <= 0:
+            return 400, {'error': 'page must be at least 1, pagelen between 1 and %d and deadline_ms positive'
+                                  % MAX_PAGE_LENGTH}, no_timings
+
+        start_time = time.time()
+        try:
+            result_page = service.search(query, page, pagelen, ranking, deadline_ms, profile)
+        except TimeoutError:
+            return 504, {'error': 'Search took longer than %g ms' % deadline_ms}, no_timings
+        except QueryError as e:
+            return 400, {'error': 'Invalid query: %s' % e}, no_timings
+        except Exception as e:
+            logger.exception('Search for %r failed', query)
+            return 500, {'error': 'Search failed: %s' % e}, no_timings
+        if result_page is None:
+            return 503, {'error': 'Too many pending searches, try again later'}, no_timings
+        return 200, {'query': query,
+                     'ranking': ranking,
+                     'profile': profile if ranking == searching.SearchEngine.CUSTOM else None,
+                     'page': result_page.page,
+                     'pagelen': result_page.pagelen,
+                     'pagecount': result_page.pagecount,
+                     'total': result_page.total,
+                     'partial': result_page.partial,
+                     'took_ms': round(1000 * (time.time() - start_time), 3),
+                     'parse_ms': round(1000 * result_page.parse_time, 3),
+                     'search_ms': round(1000 * result_page.search_time, 3),
+                     'results': [{'rank': hit.rank + 1, 'url': hit.url, 'title': hit.title, 'score': hit.score}
+                                 for hit in result_page]}, (result_page.parse_time, result_page.search_time)
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        if status == 503:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # the metrics cover the requests, logging every one of them would slow the server down
+        pass
+
+
+class SearchServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service, deadline_ms=DEFAULT_DEADLINE_MS):
+        ThreadingHTTPServer.__init__(self, address, SearchRequestHandler)
+        self.service = service
+        self.deadline_ms = deadline_ms
+
+
+def create_server(host='127.0.0.1', port=8080, workers=None, max_pending=None, deadline_ms=DEFAULT_DEADLINE_MS):
+    """Returns a SearchServer (not yet serving) for a new SearchEngine, port 0 picks a free port."""
+    service = SearchService(searching.SearchEngine(), workers, max_pending)
+    return SearchServer((host, port), service, deadline_ms)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve searches over HTTP.')
+    parser.add_argument('-host', default='127.0.0.1', help='address to listen on (default: %(default)s)')
+    parser.add_argument('-port', type=int, default=8080, help='port to listen on (default: %(default)s)')
+    parser.add_argument('-workers', type=int, default=None, help='number of search threads (default: number of cpus)')
+    parser.add_argument('-max_pending', type=int, default=None,
+                        help='number of searches admitted at once, others get 503 (default: 4 per search thread)')
+    parser.add_argument('-deadline_ms', type=float, default=DEFAULT_DEADLINE_MS,
+                        help='default time limit of a search request (default: %(default)s)')
+    args = parser.parse_args()
+
+    server = create_server(args.host, args.port, args.workers, args.max_pending, args.deadline_ms)
+    print('Serving searches on http://%s:%d/search?q=... (metrics on /metrics)' % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.close()
+
+
+check_python_version()
+
+if __name__ == "__main__":
+    main()
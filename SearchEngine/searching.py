@@ -1,14 +1,27 @@
+import hashlib
+import heapq
+import itertools
 import logging
+import multiprocessing
 import os
 import shutil
+import threading
+import time
+import uuid
+import weakref
+from collections import namedtuple
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pprint import pprint
+from urllib.parse import urlparse
 
 import math
 from whoosh.compat import iteritems
 from whoosh.scoring import WeightingModel
 
-from parsing import Document
-from utils import profile, MSG_START, MSG_SUCCESS, MSG_FAILED, print_progress, log_prof_data
+from caching import LRUCache, ShardedDocsCache, atomic_write
+from utils import profile, MSG_START, MSG_SUCCESS, MSG_FAILED, print_progress, log_prof_data, process_batch
 from multiprocessing import cpu_count
 logger = logging.getLogger(__name__)
 
@@ -16,89 +29,974 @@ try:
     from whoosh import index
     from whoosh import scoring
     from whoosh import sorting
-    from whoosh.analysis import StemmingAnalyzer, StandardAnalyzer
-    from whoosh.fields import Schema, ID, TEXT, KEYWORD, NUMERIC
-    from whoosh.qparser import QueryParser
+    from whoosh.columns import NumericColumn
+    from whoosh.analysis import StandardAnalyzer, StemFilter, Tokenizer, Token
+    from whoosh.fields import Schema, ID, TEXT, KEYWORD, NUMERIC, COLUMN
+    from whoosh.index import TOC
+    from whoosh.writing import SegmentWriter
     from whoosh.qparser import MultifieldParser
+    from whoosh.collectors import TopCollector, TimeLimitCollector, TimeLimit
+    from whoosh.matching import WrappingMatcher
+    from whoosh.query import WrappingQuery
 except ImportError as e:
     logger.error('Error: %s.\n%s\n%s', str(e), 'whoosh must be installed to proceed.', 'Command to install missing library: pip install whoosh')
     exit(1)
 
 INDEX_BASE_DIR = "index/"
+# Every build of the index is written to a new generation directory in INDEX_BASE_DIR and only published, by
+# atomically replacing the CURRENT file naming it, once it is complete
+INDEX_CURRENT_FILE = 'CURRENT'
+INDEX_GENERATION_PREFIX = 'gen-'
+# Directory of a generation in which every process using it keeps a file, so it is not garbage-collected meanwhile
+INDEX_READERS_DIR = 'readers'
+# Sub-directories of a generation split into search shards, each holding the sub-index of the documents whose url
+# hashes to it
+INDEX_SHARD_PREFIX = 'shard-'
+# Directory of a generation to which the documents are split by search shard while it is built
+INDEX_SPLIT_DIR = 'split'
 
 
-stemming_analyzer = StemmingAnalyzer(cachesize=-1)
-schema = Schema(url=ID(stored=True, unique=True),
+class SharedTokenizer(Tokenizer):
+    """
+    Tokenizes like StandardAnalyzer (regex tokens, lowercased, stop words removed), but remembers the tokens of the
+    last text it analyzed at index time.
+    Whoosh indexes the fields of a document in sorted order, so e.g. content and content_stem are analyzed one after
+    the other from the same text: the stemmed field then replays the tokens of the plain field instead of
+    tokenizing and lowercasing the text a second time.
+    The tokenizer is shared by all the fields and threads, so the last text is remembered per thread.
+    """
+
+    def __init__(self):
+        self.analyzer = StandardAnalyzer()
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return {'analyzer': self.analyzer}
+
+    def __setstate__(self, state):
+        self.analyzer = state['analyzer']
+        self._local = threading.local()
+
+    def __eq__(self, other):
+        return other and self.__class__ is other.__class__
+
+    def __call__(self, value, positions=False, chars=False, keeporiginal=False, removestops=True, start_pos=0,
+                 start_char=0, tokenize=True, mode='', **kwargs):
+        if not mode == 'index' or keeporiginal or start_pos or start_char or not tokenize:
+            return self.analyzer(value, positions=positions, chars=chars, keeporiginal=keeporiginal,
+                                 removestops=removestops, start_pos=start_pos, start_char=start_char,
+                                 tokenize=tokenize, mode=mode, **kwargs)
+
+        key = (positions, chars, removestops)
+        last = getattr(self._local, 'last', None)
+        if last is None or not (last[0] == value and last[1] == key):
+            tokens = [(t.text, t.boost, t.stopped, t.pos if positions else 0, t.startchar if chars else 0,
+                       t.endchar if chars else 0)
+                      for t in self.analyzer(value, positions=positions, chars=chars, removestops=removestops,
+                                             mode=mode, **kwargs)]
+            last = self._local.last = (value, key, tokens)
+        return self._replay(last[2], positions, chars, removestops, mode)
+
+    @staticmethod
+    def _replay(tokens, positions, chars, removestops, mode):
+        t = Token(positions, chars, removestops=removestops, mode=mode)
+        for text, boost, stopped, pos, startchar, endchar in tokens:
+            t.text = text
+            t.boost = boost
+            t.stopped = stopped
+            if positions:
+                t.pos = pos
+            if chars:
+                t.startchar = startchar
+                t.endchar = endchar
+            yield t
+
+
+shared_tokenizer = SharedTokenizer()
+# The LRU cache of the stemmer is bounded, so long running writer processes don't keep every word ever stemmed
+stemming_analyzer = shared_tokenizer | StemFilter(cachesize=50000)
+schema = Schema(url=ID(stored=True, unique=True, sortable=True),
                 path=ID(stored=True, unique=True),
-                title=TEXT(stored=True),
+                title=TEXT(analyzer=shared_tokenizer, stored=True),
                 title_stem=TEXT(analyzer=stemming_analyzer),
-                description=TEXT(),
+                description=TEXT(analyzer=shared_tokenizer),
                 description_stem=TEXT(analyzer=stemming_analyzer),
                 keywords=KEYWORD(),
                 keywords_stem=KEYWORD(analyzer=stemming_analyzer),
                 links_in_keywords=KEYWORD(),
                 links_in_keywords_stem=KEYWORD(analyzer=stemming_analyzer),
-                content=TEXT(),
+                content=TEXT(analyzer=shared_tokenizer),
                 content_stem=TEXT(analyzer=stemming_analyzer),
-                pagerank=NUMERIC(stored=True, sortable=True))
+                pagerank=NUMERIC(stored=True, sortable=True),
+                # Static ranking features, only stored as columns so they can be read per document number
+                pagerank_log=COLUMN(NumericColumn('f', default=0.0)),
+                url_depth=COLUMN(NumericColumn('H', default=0)),
+                links_in_count=COLUMN(NumericColumn('I', default=0)),
+                signature=ID(stored=True))
+
+# Named sets of field boosts of the CUSTOM ranking: the boosts of the exact fields are scaled to add up to
+# precision / (recall + precision) and those of the stemmed fields to recall / (recall + precision)
+BOOST_PROFILES = {
+    'default': {'recall': 1, 'precision': 2,
+                'fieldboosts': {"title": 2.0, "description": 1.3, "keywords": 1.5, "links_in_keywords": 1.5,
+                                "content": 1.0, "title_stem": 1.2, "description_stem": 1.1, "keywords_stem": 1.2,
+                                "links_in_keywords_stem": 1.1, "content_stem": 1.0}},
+    'recall': {'recall': 2, 'precision': 1,
+               'fieldboosts': {"title": 2.0, "description": 1.3, "keywords": 1.5, "links_in_keywords": 1.5,
+                               "content": 1.0, "title_stem": 1.2, "description_stem": 1.1, "keywords_stem": 1.2,
+                               "links_in_keywords_stem": 1.1, "content_stem": 1.0}},
+    'titles': {'recall': 1, 'precision': 2,
+               'fieldboosts': {"title": 4.0, "description": 1.3, "keywords": 1.5, "links_in_keywords": 3.0,
+                               "content": 0.5, "title_stem": 2.4, "description_stem": 1.1, "keywords_stem": 1.2,
+                               "links_in_keywords_stem": 2.2, "content_stem": 0.5}},
+}
+DEFAULT_BOOST_PROFILE = 'default'
+
+# Relative change of a pagerank which makes an otherwise unchanged document be re-indexed by an incremental update
+PAGERANK_UPDATE_TOLERANCE = 0.01
+
+# Time (in seconds) a shard search process is given on top of the deadline of a search to send back its results,
+# before the search goes on without them
+SHARD_SEARCH_GRACE = 0.1
+
+
+def get_current_generation():
+    """Returns the name of the published index generation, or None if there is none (or only an unversioned index)."""
+    try:
+        with open(os.path.join(INDEX_BASE_DIR, INDEX_CURRENT_FILE)) as handle:
+            return handle.read().strip() or None
+    except IOError:
+        return None
+
+
+def get_index_dir(generation):
+    # Indexes built before there were generations live directly in INDEX_BASE_DIR
+    return os.path.join(INDEX_BASE_DIR, generation) if generation else INDEX_BASE_DIR
+
+
+def get_generations():
+    if not os.path.isdir(INDEX_BASE_DIR):
+        return []
+    return sorted(name for name in os.listdir(INDEX_BASE_DIR)
+                  if name.startswith(INDEX_GENERATION_PREFIX) and os.path.isdir(os.path.join(INDEX_BASE_DIR, name)))
+
+
+def new_generation():
+    """Creates the directory of a new, unpublished generation and returns (generation, reader file) for it."""
+    if not os.path.isdir(INDEX_BASE_DIR):
+        logger.info('Index directory does not exist. Trying to create directory.')
+        try:
+            os.makedirs(INDEX_BASE_DIR)
+            logger.info('Directory created successfully.')
+        except Exception as e:
+            raise Exception('Failed to create directory for index: ' + str(e))
+
+    generations = get_generations()
+    number = int(generations[-1][len(INDEX_GENERATION_PREFIX):]) + 1 if generations else 1
+    while True:
+        generation = '%s%06d' % (INDEX_GENERATION_PREFIX, number)
+        try:
+            os.mkdir(get_index_dir(generation))
+            break
+        except OSError:
+            # another indexer claimed this generation first
+            number += 1
+    # The indexer registers as a reader, so the generation isn't collected as garbage while it is being built
+    return generation, register_reader(generation)
+
+
+def publish_generation(generation):
+    """Atomically makes generation the one searches are served from and collects the unused generations."""
+    atomic_write(os.path.join(INDEX_BASE_DIR, INDEX_CURRENT_FILE), generation.encode('utf-8'))
+    logger.info('Published index generation %s', generation)
+    collect_generations()
+
+
+def register_reader(generation):
+    """
+    Marks generation as in use by this process until unregister_reader is called with the returned file. Raises an
+    OSError if the generation doesn't exist (anymore).
+    """
+    readers_dir = os.path.join(get_index_dir(generation), INDEX_READERS_DIR)
+    try:
+        # not makedirs, which would bring back the directory of a collected generation
+        os.mkdir(readers_dir)
+    except FileExistsError:
+        pass
+    reader_file = os.path.join(readers_dir, '%d.%s' % (os.getpid(), uuid.uuid4().hex[:8]))
+    open(reader_file, 'w').close()
+    return reader_file
+
+
+def unregister_reader(reader_file):
+    try:
+        os.unlink(reader_file)
+    except OSError:
+        pass
 
 
-def index_docs(docs):
-    index_documents(docs)
+def is_process_alive(pid):
+    if os.name == 'nt':
+        # os.kill would terminate the process on windows, so readers are assumed to be alive there
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def has_readers(generation):
+    readers_dir = os.path.join(get_index_dir(generation), INDEX_READERS_DIR)
+    if not os.path.isdir(readers_dir):
+        return False
+    alive = False
+    for reader in os.listdir(readers_dir):
+        try:
+            pid = int(reader.split('.')[0])
+        except ValueError:
+            continue
+        if is_process_alive(pid):
+            alive = True
+        else:
+            # left behind by a process which didn't exit cleanly
+            unregister_reader(os.path.join(readers_dir, reader))
+    return alive
+
+
+def collect_generations():
+    """Deletes the generations which are neither published nor used by any (live) process."""
+    current = get_current_generation()
+    for generation in get_generations():
+        if generation == current or has_readers(generation):
+            continue
+        logger.info('Deleting unused index generation %s', generation)
+        shutil.rmtree(get_index_dir(generation), ignore_errors=True)
+
+    if current:
+        # Files of an unversioned index, which has been replaced by a generation
+        for file in os.listdir(INDEX_BASE_DIR):
+            if file.endswith(('.toc', '.seg', '.pst', '.trm', '.dci', '.dcz', '.fvz')) or file == 'MAIN_WRITELOCK':
+                try:
+                    os.unlink(os.path.join(INDEX_BASE_DIR, file))
+                except OSError:
+                    pass
+
+
+def get_search_shard(url, search_shards):
+    """Returns the number of the search shard (out of search_shards) of the document with url."""
+    return int(hashlib.md5(url.encode('utf-8')).hexdigest(), 16) % search_shards
+
+
+def get_shard_dirs(index_dir):
+    """Returns the directories of the search shards of the index in index_dir, [index_dir] if it isn't sharded."""
+    if os.path.isdir(index_dir):
+        shard_dirs = sorted(os.path.join(index_dir, name) for name in os.listdir(index_dir)
+                            if name.startswith(INDEX_SHARD_PREFIX) and os.path.isdir(os.path.join(index_dir, name)))
+        if shard_dirs:
+            return shard_dirs
+    return [index_dir]
+
+
+def link_index_files(src_dir, dst_dir):
+    """
+    Makes the files of the index in src_dir part of the (new) index in dst_dir. Whoosh never rewrites the files of
+    a segment (deletions are recorded in the TOC), so they are hard-linked rather than copied where the file system
+    allows it. The write lock is left out, the writer of dst_dir creates its own.
+    """
+    for file in os.listdir(src_dir):
+        src = os.path.join(src_dir, file)
+        if not os.path.isfile(src) or file in (INDEX_CURRENT_FILE, 'MAIN_WRITELOCK'):
+            continue
+        try:
+            os.link(src, os.path.join(dst_dir, file))
+        except OSError:
+            shutil.copy2(src, dst_dir)
+
+
+def split_docs(docs, search_shards, split_dir):
+    """
+    Returns the documents of each search shard. They are split in a single pass over docs (which may be a single-use
+    iterable), spilling the documents of each search shard to its own docs cache in split_dir.
+    """
+    if search_shards == 1:
+        return [docs]
+    writers = [ShardedDocsCache(os.path.join(split_dir, '%03d' % shard_no)).writer()
+               for shard_no in range(search_shards)]
+    for doc in docs:
+        writers[get_search_shard(doc.url, search_shards)].add(doc)
+    for writer in writers:
+        writer.commit()
+    return [writer.cache for writer in writers]
+
+
+def index_docs(docs, incremental=False, shards=1, limitmb=256, merge=False, search_shards=1):
+    index_documents(docs, incremental, shards, limitmb, merge, search_shards)
     log_prof_data(logger)
 
 
+def get_signature(doc):
+    """
+    Returns a hash of the indexed text fields (and in-link count and url depth) of the document, used to find the
+    documents which have changed.
+    """
+    md5 = hashlib.md5()
+    for text in (doc.path, doc.title, doc.description, doc.keywords, doc.links_in_keywords, doc.content,
+                 str(len(doc.links_in)), str(get_url_depth(doc.url))):
+        md5.update((text or '').encode('utf-8', errors='replace'))
+        md5.update(b'\0')
+    return md5.hexdigest()
+
+
+def is_current_schema(index_schema):
+    """Returns whether an index with index_schema has all the fields of schema, stored and as columns like in it."""
+    for name, field in schema.items():
+        if name not in index_schema:
+            return False
+        index_field = index_schema[name]
+        if not (type(index_field) is type(field) and index_field.stored == field.stored and
+                bool(index_field.column_type) == bool(field.column_type)):
+            return False
+    return True
+
+
+def get_url_depth(url):
+    """
+    Returns the number of path segments of url, which may be stored without its scheme (see UCLParser.clean_url).
+
+    >>> get_url_depth('www.ucl.ac.uk/a/b.html'), get_url_depth('http://www.ucl.ac.uk/a/b.html')
+    (2, 2)
+    >>> get_url_depth('www.ucl.ac.uk')
+    0
+    """
+    if '://' not in url:
+        # without the slashes the host would be parsed as the first segment of the path
+        url = '//' + url
+    return len([segment for segment in urlparse(url).path.split('/') if segment])
+
+
+def get_fields(doc):
+    return dict(url=doc.url,
+                path=doc.path,
+                title=doc.title,
+                title_stem=doc.title,
+                keywords=doc.keywords,
+                keywords_stem=doc.keywords,
+                links_in_keywords=doc.links_in_keywords,
+                links_in_keywords_stem=doc.links_in_keywords,
+                description=doc.description,
+                description_stem=doc.description,
+                content=doc.content,
+                content_stem=doc.content,
+                pagerank=doc.pagerank,
+                pagerank_log=math.log10(doc.pagerank + 1),
+                url_depth=min(get_url_depth(doc.url), 2 ** 16 - 1),
+                links_in_count=len(doc.links_in),
+                signature=get_signature(doc))
+
+
 @profile
-def index_documents(docs):
-    msg = "Indexing documents"
+def update_documents(ix, docs, limitmb=256):
+    """
+    Updates an existing index in place: documents which are new, whose text changed or whose pagerank changed
+    noticeably are (re-)indexed, documents which are gone are deleted and all other documents are left untouched.
+    limitmb is the memory budget of the writer. Returns whether anything was written.
+    """
+    msg = "Updating index"
     logger.info('%s %s', MSG_START, msg)
-    try:
 
-        if not os.path.isdir(INDEX_BASE_DIR):
-            logger.info('Index directory does not exist. Trying to create directory.')
-            try:
-                os.mkdir(INDEX_BASE_DIR)
-                logger.info('Directory created successfully.')
-            except Exception as e:
-                raise Exception('Failed to create directory for index: ' + str(e))
+    indexed = {}
+    with ix.searcher() as s:
+        for fields in s.all_stored_fields():
+            indexed[fields['url']] = (fields.get('signature'), fields.get('pagerank', 0.0))
 
+    writer = ix.writer(limitmb=limitmb)
+    added = changed = pagerank_changed = 0
+    seen_urls = set()
+    total_docs = len(docs)
+    for i, doc in enumerate(docs):
+        print_progress(i + 1, total_docs, 'Checked', 'documents.')
+        seen_urls.add(doc.url)
+        fields = get_fields(doc)
+        if doc.url not in indexed:
+            added += 1
         else:
-            logger.info('Index directory found. Deleting old index files...')
-            for file in os.listdir(INDEX_BASE_DIR):
-                file_path = os.path.join(INDEX_BASE_DIR, file)
-                try:
-                    if os.path.isfile(file_path):
-                        os.unlink(file_path)
-                except Exception as e:
-                    raise Exception('Failed to remove old index files: ' + str(e))
-            logger.info('Old index files deleted successfully.')
-
-        ix = index.create_in(INDEX_BASE_DIR, schema=schema)
-        writer = ix.writer(limitmb=256, procs=cpu_count(), multisegment=True)
-        total_docs = len(docs)
-        for i, doc in enumerate(docs):
-            print_progress(i + 1, total_docs, 'Indexed', 'documents.')
-            writer.add_document(url=doc.url,
-                                path=doc.path,
-                                title=doc.title,
-                                title_stem=doc.title,
-                                keywords=doc.keywords,
-                                keywords_stem=doc.keywords,
-                                links_in_keywords=doc.links_in_keywords,
-                                links_in_keywords_stem=doc.links_in_keywords,
-                                description=doc.description,
-                                description_stem=doc.description,
-                                content=doc.content,
-                                content_stem=doc.content,
-                                pagerank=doc.pagerank)
+            signature, pagerank = indexed[doc.url]
+            if not signature == fields['signature']:
+                changed += 1
+            elif abs(pagerank - doc.pagerank) > PAGERANK_UPDATE_TOLERANCE * max(pagerank, doc.pagerank):
+                pagerank_changed += 1
+            else:
+                continue
+        writer.update_document(**fields)
+
+    removed = 0
+    for url in indexed:
+        if url not in seen_urls:
+            writer.delete_by_term('url', url)
+            removed += 1
 
+    logger.info("Added: %d, changed: %d, pagerank changed: %d, removed: %d, unchanged: %d", added, changed,
+                pagerank_changed, removed, len(seen_urls) - added - changed - pagerank_changed)
+    updated = bool(added or changed or pagerank_changed or removed)
+    if updated:
         logger.info('%s Writing index to file', MSG_START)
-        writer.commit(optimize=True)
+        # Let the merge policy merge the small segments instead of optimizing the whole index on every update
+        writer.commit(merge=True)
         logger.info('%s Writing index to file', MSG_SUCCESS)
+    else:
+        writer.cancel()
+    logger.info('%s %s', MSG_SUCCESS, msg)
+    return updated
+
+
+@profile
+def index_documents(docs, incremental=False, shards=1, limitmb=256, merge=False, search_shards=1):
+    """
+    Creates the index from scratch or, with incremental=True and an existing index, only applies the differences
+    between the index and docs to it.
+    With shards > 1 the index is built by that many independent worker processes (see index_documents_sharded),
+    whose segments are merged into a single one if merge is True.
+    limitmb is the memory budget of each writer process.
+    With search_shards > 1 the documents are split by the hash of their url into that many sub-indexes (search
+    shards), which the SearchEngine searches concurrently.
+    """
+    msg = "Indexing documents"
+    logger.info('%s %s', MSG_START, msg)
+    generation = reader_file = None
+    try:
+        current_dirs = get_shard_dirs(get_index_dir(get_current_generation()))
+        generation, reader_file = new_generation()
+        index_dir = get_index_dir(generation)
+        logger.info('Building index generation %s', generation)
+        if search_shards > 1:
+            index_dirs = [os.path.join(index_dir, '%s%03d' % (INDEX_SHARD_PREFIX, shard_no))
+                          for shard_no in range(search_shards)]
+        else:
+            index_dirs = [index_dir]
+        split_dir = os.path.join(index_dir, INDEX_SPLIT_DIR)
+
+        if incremental and all(index.exists_in(current_dir) for current_dir in current_dirs):
+            if len(current_dirs) == search_shards and is_current_schema(index.open_dir(current_dirs[0]).schema):
+                updated = False
+                shard_docs_list = split_docs(docs, search_shards, split_dir)
+                for shard_no, (current_dir, shard_dir, shard_docs) in enumerate(zip(current_dirs, index_dirs,
+                                                                                      shard_docs_list)):
+                    if not os.path.isdir(shard_dir):
+                        os.makedirs(shard_dir)
+                    # The published generation stays untouched (and searchable) while a copy of it is updated
+                    link_index_files(current_dir, shard_dir)
+                    if search_shards > 1:
+                        logger.info('Updating search shard %d of %d', shard_no + 1, search_shards)
+                    updated = update_documents(index.open_dir(shard_dir), shard_docs, limitmb) or updated
+                if updated:
+                    publish_generation(generation)
+                logger.info('%s %s', MSG_SUCCESS, msg)
+                return
+            logger.info('Index was created with an older schema or another number of search shards, rebuilding it.')
+
+        shard_docs_list = split_docs(docs, search_shards, split_dir)
+        for shard_no, (shard_dir, shard_docs) in enumerate(zip(index_dirs, shard_docs_list)):
+            if not os.path.isdir(shard_dir):
+                os.makedirs(shard_dir)
+            if search_shards > 1:
+                logger.info('Building search shard %d of %d', shard_no + 1, search_shards)
+            build_index(index.create_in(shard_dir, schema=schema), shard_docs, shards, limitmb, merge)
+        publish_generation(generation)
         logger.info('%s %s', MSG_SUCCESS, msg)
     except Exception as e:
         logger.warning('%s', e)
         logger.warning('%s %s', MSG_FAILED, msg)
+    finally:
+        if generation:
+            shutil.rmtree(os.path.join(get_index_dir(generation), INDEX_SPLIT_DIR), ignore_errors=True)
+        if reader_file:
+            unregister_reader(reader_file)
+        if generation and not generation == get_current_generation():
+            # failed or unchanged builds are thrown away
+            collect_generations()
+
+
+def build_index(ix, docs, shards=1, limitmb=256, merge=False):
+    """Indexes docs into the new (empty) index ix, see index_documents."""
+    if shards > 1:
+        index_documents_sharded(ix, docs, shards, limitmb, merge)
+        return
+
+    writer = ix.writer(limitmb=limitmb, procs=cpu_count(), multisegment=True)
+    total_docs = len(docs)
+    for i, doc in enumerate(docs):
+        print_progress(i + 1, total_docs, 'Indexed', 'documents.')
+        writer.add_document(**get_fields(doc))
+
+    logger.info('%s Writing index to file', MSG_START)
+    writer.commit(optimize=True)
+    logger.info('%s Writing index to file', MSG_SUCCESS)
+
+
+def index_shard(index_dir, shard_no, docs, limitmb):
+    """
+    Indexes docs into a new segment of the (empty) index in index_dir, in a worker process.
+    Like the sub-writers of whoosh's own multiprocessing writer, the segment is finalized but not committed: the
+    parent process adds the segments of all shards to the index in one go.
+    Returns (shard_no, segment, number of docs, bytes of text, seconds taken).
+    """
+    start_time = time.time()
+    ix = index.open_dir(index_dir)
+    writer = SegmentWriter(ix, _lk=False, limitmb=limitmb)
+    total_docs = 0
+    total_bytes = 0
+    for doc in docs:
+        fields = get_fields(doc)
+        writer.add_document(**fields)
+        total_docs += 1
+        total_bytes += sum(len(fields[name].encode('utf-8')) for name in ('title', 'description', 'keywords',
+                                                                            'links_in_keywords', 'content'))
+    segment = writer._finalize_segment()
+    writer._finish()
+    return shard_no, segment, total_docs, total_bytes, time.time() - start_time
+
+
+@profile
+def index_documents_sharded(ix, docs, shards, limitmb=256, merge=False):
+    """
+    Builds the index with shards worker processes, each indexing its own partition of docs into its own segment,
+    and then adds all the segments to the index at once. A sharded docs cache with enough shard files is partitioned by
+    them, so the workers read their documents from disk themselves instead of receiving them from this process.
+    With merge=True the segments are then merged into one, which makes searching a little faster but is done by a
+    single process.
+    """
+    if isinstance(docs, ShardedDocsCache) and len(docs.index['shards']) >= shards:
+        partitions = docs.partition(shards)
+    else:
+        docs = list(docs)
+        partitions = [docs[i::shards] for i in range(min(shards, len(docs)))]
+
+    logger.info('Indexing %d documents in %d shards', len(docs), len(partitions))
+    start_time = time.time()
+    args_list = [(ix.storage.folder, i, partition, limitmb) for i, partition in enumerate(partitions)]
+    results = process_batch(args_list, index_shard, process_no=max(1, len(partitions)))
+
+    for shard_no, segment, total_docs, total_bytes, time_taken in results:
+        logger.info("Shard %d: %d docs in %.2fs (%.1f docs/s, %.2f MB/s)", shard_no, total_docs, time_taken,
+                    total_docs / time_taken if time_taken else 0, total_bytes / 2 ** 20 / time_taken if time_taken else 0)
+
+    logger.info('%s Writing index to file', MSG_START)
+    TOC(ix.schema, [segment for _, segment, _, _, _ in results], ix.latest_generation() + 1).write(ix.storage,
+                                                                                                 ix.indexname)
+    logger.info('%s Writing index to file', MSG_SUCCESS)
+
+    if merge:
+        logger.info('%s Merging %d segments', MSG_START, len(results))
+        ix.optimize()
+        logger.info('%s Merging %d segments', MSG_SUCCESS, len(results))
+
+    time_taken = time.time() - start_time
+    logger.info("Total: %d docs in %.2fs (%.1f docs/s)", len(docs), time_taken, len(docs) / time_taken if time_taken else 0)
+
+
+def normalize_field_boosts(fieldboosts, recall, precision):
+    """Returns the field boosts scaled as described for BOOST_PROFILES."""
+    total_standard = sum([value for key, value in fieldboosts.items() if not key.endswith('_stem')])
+    total_stem = sum([value for key, value in fieldboosts.items() if key.endswith('_stem')])
+
+    normalized = {}
+    for key, value in fieldboosts.items():
+        if key.endswith('_stem'):
+            normalized[key] = (value / total_stem) * (recall / (recall + precision))
+        else:
+            normalized[key] = (value / total_standard) * (precision / (recall + precision))
+    return normalized
+
+
+def normalize_query(query):
+    """
+    Returns query with its whitespace collapsed, as the key of the caches. Case is kept: the KEYWORD fields don't
+    lowercase their terms, so queries differing only in case can match and score differently.
+    """
+    return ' '.join(query.split())
+
+
+class ScaledScorer(scoring.BaseScorer):
+    """Scores like the scorer it wraps, multiplied by factor (and so are its quality bounds)."""
+
+    def __init__(self, scorer, factor):
+        self.scorer = scorer
+        self.factor = factor
+
+    def supports_block_quality(self):
+        return self.scorer.supports_block_quality()
+
+    def score(self, matcher):
+        return self.factor * self.scorer.score(matcher)
+
+    def max_quality(self):
+        return self.factor * self.scorer.max_quality()
+
+    def block_quality(self, matcher):
+        return self.factor * self.scorer.block_quality(matcher)
+
+
+class PriorScorer(scoring.BaseScorer):
+    """Scores a document by its log pagerank column, normalised by the largest one of the index, times weight."""
+
+    def __init__(self, pagerank_log, max_pagerank_log, weight):
+        self.pagerank_log = pagerank_log
+        self.factor = weight / max_pagerank_log if max_pagerank_log else 0.0
+        self.weight = weight
+
+    def supports_block_quality(self):
+        return True
+
+    def score(self, matcher):
+        return self.factor * self.pagerank_log[matcher.id()]
+
+    def max_quality(self):
+        return self.weight
+
+    def block_quality(self, matcher):
+        return self.weight
+
+
+class FusionWeighting(WeightingModel):
+    """
+    Scores documents by text_weight times their text score (of the text weighting) plus prior_weight times their
+    normalised log pagerank. The text terms are scored by scaled scorers of the text weighting, the pagerank is added
+    once per document by the matcher of a FusionQuery.
+    """
+
+    def __init__(self, text=None, text_weight=0.6, prior_weight=0.4):
+        self.text = text or scoring.BM25F()
+        self.text_weight = text_weight
+        self.prior_weight = prior_weight
+        # largest log pagerank of the index of each (top level) reader
+        self._max_pagerank_logs = weakref.WeakKeyDictionary()
+
+    def max_pagerank_log(self, searcher):
+        reader = searcher.get_parent().reader()
+        if reader not in self._max_pagerank_logs:
+            self._max_pagerank_logs[reader] = max(reader.column_reader('pagerank_log'), default=0.0)
+        return self._max_pagerank_logs[reader]
+
+    def scorer(self, searcher, fieldname, text, qf=1):
+        return ScaledScorer(self.text.scorer(searcher, fieldname, text, qf=qf), self.text_weight)
+
+    def prior_scorer(self, searcher, max_pagerank_log=None):
+        """Returns the PriorScorer of searcher, normalised by max_pagerank_log if given (else that of the index)."""
+        if max_pagerank_log is None:
+            max_pagerank_log = self.max_pagerank_log(searcher)
+        return PriorScorer(searcher.reader().column_reader('pagerank_log'), max_pagerank_log, self.prior_weight)
+
+
+class CorpusStats(object):
+    """
+    Corpus-wide statistics of an index split into search shards, summed over readers of all the shards. The scorers
+    of every shard use them instead of the statistics of their own shard, so the scores of all shards are comparable.
+    Only used by the (single-threaded) shard search processes.
+    """
+
+    def __init__(self, readers, max_terms=100000):
+        self.readers = readers
+        self._doc_count_all = sum(reader.doc_count_all() for reader in readers)
+        self.max_pagerank_log = max([max(reader.column_reader('pagerank_log'), default=0.0)
+                                     for reader in readers if reader.doc_count_all()], default=0.0)
+        self._field_lengths = {}
+        self._term_stats = LRUCache(max_terms)
+
+    def doc_count_all(self):
+        return self._doc_count_all
+
+    def doc_count(self):
+        return self._doc_count_all
+
+    def field_length(self, fieldname):
+        if fieldname not in self._field_lengths:
+            self._field_lengths[fieldname] = sum(reader.field_length(fieldname) for reader in self.readers)
+        return self._field_lengths[fieldname]
+
+    def avg_field_length(self, fieldname, default=None):
+        if not schema[fieldname].scorable:
+            return default
+        return self.field_length(fieldname) / (self._doc_count_all or 1)
+
+    def term_stats(self, fieldname, text):
+        """Returns the (document frequency, frequency) of the term in the whole corpus."""
+        key = (fieldname, text)
+        stats = self._term_stats.get(key)
+        if stats is None:
+            stats = (sum(reader.doc_frequency(fieldname, text) for reader in self.readers),
+                     sum(reader.frequency(fieldname, text) for reader in self.readers))
+            self._term_stats.put(key, stats)
+        return stats
+
+    def doc_frequency(self, fieldname, text):
+        return self.term_stats(fieldname, text)[0]
+
+    def frequency(self, fieldname, text):
+        return self.term_stats(fieldname, text)[1]
+
+    def idf(self, fieldname, text):
+        # like whoosh's weighting models compute it
+        return math.log(self._doc_count_all / (self.doc_frequency(fieldname, text) + 1)) + 1
+
+    def close(self):
+        for reader in self.readers:
+            reader.close()
+
+
+class CorpusSearcher(object):
+    """
+    A (leaf) searcher of a search shard as its scorers see it: with the corpus-wide statistics of corpus_stats and
+    everything else of the searcher. It is its own parent, which is where the scorers look the statistics up.
+    """
+
+    def __init__(self, searcher, corpus_stats):
+        self.searcher = searcher
+        self.corpus_stats = corpus_stats
+
+    def get_parent(self):
+        return self
+
+    def doc_count_all(self):
+        return self.corpus_stats.doc_count_all()
+
+    def doc_count(self):
+        return self.corpus_stats.doc_count()
+
+    def field_length(self, fieldname):
+        return self.corpus_stats.field_length(fieldname)
+
+    def avg_field_length(self, fieldname, default=None):
+        return self.corpus_stats.avg_field_length(fieldname, default)
+
+    def doc_frequency(self, fieldname, text):
+        return self.corpus_stats.doc_frequency(fieldname, text)
+
+    def frequency(self, fieldname, text):
+        return self.corpus_stats.frequency(fieldname, text)
+
+    def idf(self, fieldname, text):
+        return self.corpus_stats.idf(fieldname, text)
+
+    def __getattr__(self, name):
+        return getattr(self.searcher, name)
+
+
+class CorpusWeighting(WeightingModel):
+    """Scores like the weighting it wraps, but with the corpus-wide statistics of corpus_stats (see CorpusStats)."""
+
+    def __init__(self, weighting, corpus_stats):
+        self.weighting = weighting
+        self.corpus_stats = corpus_stats
+        self.use_final = weighting.use_final
+
+    def scorer(self, searcher, fieldname, text, qf=1):
+        return self.weighting.scorer(CorpusSearcher(searcher, self.corpus_stats), fieldname, text, qf=qf)
+
+    def final(self, searcher, docnum, score):
+        return self.weighting.final(searcher, docnum, score)
+
+    def prior_scorer(self, searcher):
+        """Returns the prior scorer of the wrapped FusionWeighting, normalised by the largest pagerank of the corpus."""
+        return self.weighting.prior_scorer(searcher, self.corpus_stats.max_pagerank_log)
+
+
+class FusionMatcher(WrappingMatcher):
+    """
+    Adds the prior score of every document to its score by the wrapped matcher. The quality bounds are those of the
+    wrapped matcher plus the largest prior score, so blocks which can't make it into the top results even with the
+    best prior are still skipped.
+    """
+
+    def __init__(self, child, prior_scorer, boost=1.0):
+        self.child = child
+        self.prior_scorer = prior_scorer
+        self.boost = boost
+
+    def copy(self):
+        return self.__class__(self.child.copy(), self.prior_scorer, boost=self.boost)
+
+    def _replacement(self, newchild):
+        return self.__class__(newchild, self.prior_scorer, boost=self.boost)
+
+    def replace(self, minquality=0):
+        if minquality:
+            minquality = max(0, minquality - self.prior_scorer.max_quality())
+        return WrappingMatcher.replace(self, minquality)
+
+    def max_quality(self):
+        return self.child.max_quality() + self.prior_scorer.max_quality()
+
+    def block_quality(self):
+        return self.child.block_quality() + self.prior_scorer.max_quality()
+
+    def skip_to_quality(self, minquality):
+        return self.child.skip_to_quality(minquality - self.prior_scorer.max_quality())
+
+    def score(self):
+        return self.child.score() + self.prior_scorer.score(self.child)
+
+
+class FusionQuery(WrappingQuery):
+    """Matches the documents of its child query; with a FusionWeighting they are also scored by their pagerank."""
+
+    def matcher(self, searcher, context=None):
+        m = self.child.matcher(searcher, context)
+        weighting = context.weighting if context else searcher.weighting
+        fusion = weighting.weighting if isinstance(weighting, CorpusWeighting) else weighting
+        if not isinstance(fusion, FusionWeighting) or not m.is_active():
+            return m
+        return FusionMatcher(m, weighting.prior_scorer(searcher))
+
+
+def collect_results(searcher, q, collector, timelimit=None):
+    """
+    Runs q with collector and returns its whoosh Results and whether they are partial: if timelimit (in seconds) is
+    not None, the search stops once it runs out of time and the results are the best ones found until then.
+    """
+    if timelimit is None:
+        searcher.search_with_collector(q, collector)
+        return collector.results(), False
+
+    # The alarm signal, which whoosh uses by default, can only be handled by the main thread. Without it the time is
+    # checked between every collected document.
+    collector = TimeLimitCollector(collector, max(timelimit, 0.0), use_alarm=False)
+    try:
+        searcher.search_with_collector(q, collector)
+    except TimeLimit:
+        return collector.results(), True
+    return collector.results(), False
+
+
+def search_top(searcher, q, limit, timelimit=None):
+    """
+    Returns the exact top limit results of q and whether they are partial (see collect_results).
+    Whoosh's default collector regularly replaces the matchers with cheaper ones, which drops the optional side of
+    AndMaybe matchers (which it also creates from unions) while it can still add to the score, so documents can end
+    up with less than their score. Without the replacement, whoosh still skips the blocks of postings whose quality
+    is too low.
+    """
+    return collect_results(searcher, q, TopCollector(limit=limit, replace=0), timelimit)
+
+
+# Compact search result, as returned by SearchEngine.search_many
+SearchResult = namedtuple('SearchResult', ['url', 'score', 'rank'])
+
+
+class HitList(list):
+    """List of Hit, partial is True if the search ran out of time before it found all the matching documents."""
+
+    def __init__(self, hits=(), partial=False):
+        list.__init__(self, hits)
+        self.partial = partial
+
+
+class Hit(object):
+    """
+    Read-only search result: its score and rank (from 0) and its stored fields (only the requested ones, if the
+    search had a fields projection) as attributes, e.g. hit.url.
+    """
+    __slots__ = ('score', 'rank', '_fields')
+
+    def __init__(self, score, rank, fields):
+        object.__setattr__(self, 'score', score)
+        object.__setattr__(self, 'rank', rank)
+        object.__setattr__(self, '_fields', fields)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._fields[name]
+        except KeyError:
+            raise AttributeError("Field not loaded: %s" % name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Hit is read-only")
+
+    def __getstate__(self):
+        return self.score, self.rank, self._fields
+
+    def __setstate__(self, state):
+        Hit.__init__(self, *state)
+
+    def fields(self):
+        return dict(self._fields)
+
+    def __repr__(self):
+        return "<Hit %d %r %s>" % (self.rank, self._fields.get('url'), self.score)
+
+
+def load_fields(searcher, docnums, fields=None):
+    """
+    Returns the stored fields in fields only (all if None) of the documents docnums, as dictionaries.
+    Fields which are also columns, like the url, are read from their column without loading the stored fields.
+    """
+    if fields is None:
+        return [searcher.stored_fields(docnum) for docnum in docnums]
+
+    reader = searcher.reader()
+    columns = dict((field, reader.column_reader(field)) for field in fields if reader.has_column(field))
+    docs = []
+    for docnum in docnums:
+        stored = searcher.stored_fields(docnum) if len(columns) < len(fields) else {}
+        docs.append(dict((field, columns[field][docnum] if field in columns else stored.get(field))
+                         for field in fields))
+    return docs
+
+
+def load_hits(searcher, results, fields=None, start=0, end=None):
+    """Returns the results from start to end as Hit objects, with the stored fields in fields (see load_fields)."""
+    ranks = range(start, min(end, len(results.top_n)) if end is not None else len(results.top_n))
+    docs = load_fields(searcher, [results.docnum(rank) for rank in ranks], fields)
+    return [Hit(results.score(rank), rank, doc_fields) for rank, doc_fields in zip(ranks, docs)]
+
+
+class SearcherPool(object):
+    """
+    Keeps the searchers of an index open between queries, per ranking, so their readers and caches stay warm.
+    A searcher is only ever used by one thread at a time: searcher() hands out an idle one (or opens a new one if all
+    are busy) and takes it back afterwards. Once the pool is closed, searchers are closed instead of taken back.
+    """
+
+    def __init__(self, ix, weightings, max_idle=4):
+        self.ix = ix
+        self.weightings = weightings
+        self.max_idle = max_idle
+        self.closed = False
+        self._idle = dict((ranking, []) for ranking in weightings)
+        self._lock = threading.Lock()
+
+    def acquire(self, ranking):
+        with self._lock:
+            if self._idle[ranking]:
+                return self._idle[ranking].pop()
+        return self.ix.searcher(weighting=self.weightings[ranking])
+
+    def release(self, ranking, searcher):
+        with self._lock:
+            if not self.closed and len(self._idle[ranking]) < self.max_idle:
+                self._idle[ranking].append(searcher)
+                return
+        searcher.close()
+
+    @contextmanager
+    def searcher(self, ranking):
+        searcher = self.acquire(ranking)
+        try:
+            yield searcher
+        finally:
+            self.release(ranking, searcher)
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            idle = [searcher for searchers in self._idle.values() for searcher in searchers]
+            self._idle = dict((ranking, []) for ranking in self.weightings)
+        for searcher in idle:
+            searcher.close()
 
 
 class SearchEngine(object):
@@ -110,100 +1008,488 @@ class SearchEngine(object):
     PAGERANK = 'pagerank'
     CUSTOM = 'custom'
 
-    def __init__(self):
+    def __init__(self, cache_size=1000, cache_ttl=600, query_cache_size=1000):
+        """
+        Search results are cached for up to cache_ttl seconds, for the cache_size most recent queries. The parsed
+        queries are cached for the query_cache_size most recent queries.
+        """
+        self.result_cache = LRUCache(cache_size, cache_ttl)
+        self.query_cache = LRUCache(query_cache_size)
+        # the index and its SearcherPool, None if the index is split into search shards
+        self.ix = None
+        self.generation = None
+        self.searchers = None
+        # the SearcherPool of every search shard of the index (only one if it isn't sharded)
+        self.shards = None
+        # worker processes searching the shards of a sharded index, see search_shard
+        self._shard_pool = None
+        self._shard_pool_size = 0
+        # (generation, shards, shard pool) of the open index, replaced as a whole so a search sees a consistent one
+        self._index_state = None
+        self._reader_file = None
+        self._lock = threading.Lock()
+        # number of searches given a time budget, and of those which ran out of it
+        self.deadline_searches = 0
+        self.deadline_exceeded = 0
+        self._stats_lock = threading.Lock()
+        self.scorers_dict = SearchEngine.create_weightings()
+
+        self.rankings = self.scorers_dict.keys()
+
         try:
-            self.ix = index.open_dir(INDEX_BASE_DIR)
+            self._open_index()
         except Exception as e:
             logger.error("Could not open index file: %s" % e)
             logger.info("To be able to search, an index has to be created first. Use index_website.py to create the index.")
             raise e
 
-        self.scorers_dict = {
-            SearchEngine.FREQUENCY: scoring.Frequency(),
-            SearchEngine.BM25: scoring.BM25F(),
-            SearchEngine.TF_IDF: scoring.TF_IDF(),
-            SearchEngine.PL2: scoring.PL2(),
-            SearchEngine.PAGERANK: scoring.Frequency(),
-            # Change the scoring with the custom scoring, once implemented
-            SearchEngine.CUSTOM: scoring.MultiWeighting(
-                default=scoring.BM25F(),
-                # content=scoring.PL2(),
-                # content_stem=scoring.PL2()
-            )}
-
-        self.rankings = self.scorers_dict.keys()
         self.qp = MultifieldParser(
             ["title_stem", "description_stem", "keywords_stem", "content_stem"],
             schema=schema)
 
-        recall = 1
-        precision = 2
-        fieldboosts={"title": 2.0, "description": 1.3, "keywords": 1.5, "links_in_keywords": 1.5, "content": 1.0,
-                     "title_stem": 1.2, "description_stem": 1.1, "keywords_stem": 1.2, "links_in_keywords_stem": 1.1, "content_stem": 1.0}
+        # A parser of the CUSTOM ranking for every boost profile
+        self.custom_parsers = {}
+        for name, boosts in BOOST_PROFILES.items():
+            self.add_boost_profile(name, boosts['fieldboosts'], boosts['recall'], boosts['precision'])
+        self.qp_custom = self.custom_parsers[DEFAULT_BOOST_PROFILE]
 
-        total_standard = sum([value for key, value in fieldboosts.items() if not key.endswith('_stem')])
-        total_stem = sum([value for key, value in fieldboosts.items() if key.endswith('_stem')])
-
-        for key, value in fieldboosts.items():
-            if key.endswith('_stem'):
-                fieldboosts[key] = (fieldboosts[key] / total_stem) * (recall / (recall + precision))
-            else:
-                fieldboosts[key] = (fieldboosts[key] / total_standard) * (precision / (recall + precision))
+    @staticmethod
+    def create_weightings():
+        """Returns the weighting model of every ranking."""
+        return {
+            SearchEngine.FREQUENCY: scoring.Frequency(),
+            SearchEngine.BM25: scoring.BM25F(),
+            SearchEngine.TF_IDF: scoring.TF_IDF(),
+            SearchEngine.PL2: scoring.PL2(),
+            SearchEngine.PAGERANK: scoring.Frequency(),
+            SearchEngine.CUSTOM: FusionWeighting(text=scoring.BM25F(), text_weight=0.6, prior_weight=0.4)}
 
-        self.qp_custom = MultifieldParser(
+    def add_boost_profile(self, name, fieldboosts, recall=1, precision=2):
+        """Adds (or replaces) the boost profile name of the CUSTOM ranking, see BOOST_PROFILES."""
+        self.custom_parsers[name] = MultifieldParser(
             ["title", "description", "keywords", "links_in_keywords", "content",
              "title_stem", "description_stem", "keywords_stem", "links_in_keywords_stem", "content_stem"],
             schema=schema,
-            fieldboosts=fieldboosts
+            fieldboosts=normalize_field_boosts(fieldboosts, recall, precision)
         )
+        # queries parsed and results ranked with the old boosts of the profile
+        self.query_cache.clear()
+        self.result_cache.clear()
+
+    @property
+    def boost_profiles(self):
+        return self.custom_parsers.keys()
+
+    def parse_query(self, query, ranking=CUSTOM, profile_name=None):
+        """
+        Returns the parsed query for ranking (with the boosts of the profile profile_name for the CUSTOM ranking) and
+        the time it took in seconds. The parsed queries are cached, so parsing the same query again is almost free.
+        """
+        start_time = time.time()
+        profile_name = self._profile(ranking, profile_name)
+        parser = self.custom_parsers[profile_name] if profile_name is not None else self.qp
+        key = (normalize_query(query), profile_name)
+        q = self.query_cache.get(key)
+        if q is None:
+            q = parser.parse(query)
+            self.query_cache.put(key, q)
+        return q, time.time() - start_time
+
+    @staticmethod
+    def _profile(ranking, profile_name):
+        """Returns the name of the boost profile used by ranking, None if it doesn't use any."""
+        if ranking == SearchEngine.CUSTOM:
+            return profile_name or DEFAULT_BOOST_PROFILE
+        return None
 
-    def search(self, query, limit=10, ranking=CUSTOM):
-        """Returns a list of sorted Document based on query"""
+    def _check_request(self, rankings, profile_name):
+        for ranking in rankings:
+            if ranking not in self.scorers_dict:
+                logger.error("Invalid ranking: %s", ranking)
+                raise ValueError("Ranking must be one of these: %s", ', '.join(self.rankings))
+        if profile_name is not None and profile_name not in self.custom_parsers:
+            logger.error("Invalid boost profile: %s", profile_name)
+            raise ValueError("Boost profile must be one of these: %s" % ', '.join(self.boost_profiles))
+
+    def _open_index(self):
+        """Opens the published generation. Only called by the constructor, and by refresh holding self._lock."""
+        while True:
+            generation = get_current_generation()
+            reader_file = None
+            try:
+                # registered before it is opened, so the generation can't be collected in between
+                reader_file = register_reader(generation) if generation else None
+                shard_ixs = [index.open_dir(shard_dir) for shard_dir in get_shard_dirs(get_index_dir(generation))]
+                break
+            except Exception:
+                if reader_file:
+                    unregister_reader(reader_file)
+                if generation is None or get_current_generation() == generation:
+                    raise
+                # the generation was replaced and collected before it was registered, open the new one
+        old_reader_file = self._reader_file
+        old_shards = self.shards
+        old_shard_pool = None
+        shard_pool_size = min(len(shard_ixs), cpu_count()) if len(shard_ixs) > 1 else 0
+        if not shard_pool_size == self._shard_pool_size:
+            # whoosh scoring holds the GIL, so the shards are searched by processes. They open the shards themselves,
+            # this process only loads the stored fields of the merged top results from its searchers.
+            old_shard_pool = self._shard_pool
+            self._shard_pool = get_shard_pool_context().Pool(shard_pool_size) if shard_pool_size else None
+            self._shard_pool_size = shard_pool_size
+        shards = [SearcherPool(ix, self.scorers_dict) for ix in shard_ixs]
+        self.ix = shard_ixs[0] if len(shard_ixs) == 1 else None
+        self.searchers = shards[0] if len(shards) == 1 else None
+        self.shards, self.generation = shards, generation
+        self._index_state = (generation, shards, self._shard_pool)
+        self._reader_file = reader_file
+        if old_shards:
+            # searchers still in use by other threads are closed when they are released
+            for searchers in old_shards:
+                searchers.close()
+        if old_shard_pool:
+            # its workers exit once they have finished the searches already submitted to them
+            old_shard_pool.close()
+        self.result_cache.clear()
+        if old_reader_file:
+            unregister_reader(old_reader_file)
+
+    def refresh(self):
+        """Switches to the latest published index generation, if it changed. Returns whether it did."""
+        if get_current_generation() == self.generation:
+            return False
+        with self._lock:
+            generation = get_current_generation()
+            if generation == self.generation:
+                # another thread already switched
+                return False
+            logger.info("Index generation changed from %s to %s, reopening index", self.generation, generation)
+            self._open_index()
+        # the search which noticed the new generation doesn't wait for the replaced ones to be deleted
+        threading.Thread(target=collect_generations, name='collect-generations', daemon=True).start()
+        return True
+
+    def close(self):
+        """Closes the searchers and releases the index generation, so it can be garbage-collected once replaced."""
+        for searchers in self.shards or []:
+            searchers.close()
+        if self._shard_pool:
+            self._shard_pool.terminate()
+            self._shard_pool = None
+            self._shard_pool_size = 0
+        if self._reader_file:
+            unregister_reader(self._reader_file)
+            self._reader_file = None
+
+    def search(self, query, limit=10, ranking=CUSTOM, fields=None, profile_name=None, deadline_ms=None):
+        """
+        Returns a HitList of sorted Hit based on query. fields is the list of stored fields loaded for every hit (all
+        of them if None), e.g. ('url',). profile_name is the name of the boost profile of the CUSTOM ranking.
+        If the search takes longer than deadline_ms (if not None), it stops and returns the best hits found until then,
+        flagged as partial.
+        """
         logger.info("Received search request: Query: %s | Limit: %d | Ranking: %s", query, limit, ranking)
+        start_time = time.time()
+        self.refresh()
+        self._check_request([ranking], profile_name)
 
-        try:
-            scoring_method = self.scorers_dict[ranking]
-        except KeyError:
-            logger.error("Invalid ranking: %s", ranking)
-            raise ValueError("Ranking must be one of these: %s", ', '.join(self.rankings))
-
-        docs = []
-
-        with self.ix.searcher(weighting=scoring_method) as s:
-            if ranking == SearchEngine.CUSTOM:
-                q = self.qp_custom.parse(query)
-                results = s.search(q, limit=max(limit, 100))
-
-                if not results.is_empty():
-                    # max_score = max([r.score for r in results])
-                    max_pagerank = math.log10(max([r.fields()["pagerank"] for r in results]) + 1)
-                    result_list = []
-                    for result in results:
-                        fields = result.fields()
-                        # result.score = result.score/max_score
-                        pagerank_normalised = math.log10(fields["pagerank"] + 1) / max_pagerank
-                        result.score = 0.6 * result.score + 0.4 * pagerank_normalised
-                        result_list.append(result)
-                    result_list.sort(key=lambda x: x.score, reverse=True)
-                    for i, result in enumerate(result_list[:limit]):
-                        doc = Document(**result.fields())
-                        docs.append(doc)
-                        # print(str(i) + ". ", doc.url, result.score, result.rank, result.combined, doc.pagerank)
-                    return docs
+        # The generation is part of the key, so results of a search still running on the previous generation are
+        # never served for the new one
+        fields = tuple(fields) if fields is not None else None
+        key = (self.generation, normalize_query(query), ranking, self._profile(ranking, profile_name), limit, fields)
+        hits = self.result_cache.get(key)
+        partial = False
+        if hits is None:
+            q, parse_time = self.parse_query(query, ranking, profile_name)
+            search_start_time = time.time()
+            hits, _, partial = self._search_hits(q, ranking, 0, limit, fields, self._timelimit(deadline_ms, start_time))
+            logger.info("\tParse time: %.2f ms | Search time: %.2f ms", 1000 * parse_time,
+                        1000 * (time.time() - search_start_time))
+            if not partial:
+                self.result_cache.put(key, hits)
+        else:
+            logger.info("\tServed from result cache")
+        return HitList(hits, partial)
+
+    def search_page(self, query, page=1, pagelen=10, ranking=CUSTOM, fields=None, profile_name=None,
+                    deadline_ms=None):
+        """
+        Returns the ResultPage with the page-th (counting from 1) pagelen results of query. Only the results up to
+        that page are ranked and only the hits of the page are loaded, with the stored fields in fields (see search).
+        If the search takes longer than deadline_ms, the page is partial (see search).
+        """
+        logger.info("Received search page request: Query: %s | Page: %d | Page length: %d | Ranking: %s", query,
+                    page, pagelen, ranking)
+        start_time = time.time()
+        self.refresh()
+        self._check_request([ranking], profile_name)
+        if page < 1:
+            raise ValueError("Page numbers start at 1")
+
+        fields = tuple(fields) if fields is not None else None
+        key = (self.generation, normalize_query(query), ranking, self._profile(ranking, profile_name), 'page', page,
+               pagelen, fields)
+        result_page = self.result_cache.get(key)
+        if result_page is None:
+            q, parse_time = self.parse_query(query, ranking, profile_name)
+            search_start_time = time.time()
+            hits, total, partial = self._search_hits(q, ranking, (page - 1) * pagelen, page * pagelen, fields,
+                                                     self._timelimit(deadline_ms, start_time))
+            result_page = ResultPage(hits, page, pagelen, total, parse_time, time.time() - search_start_time, partial)
+            logger.info("\tParse time: %.2f ms | Search time: %.2f ms", 1000 * result_page.parse_time,
+                        1000 * result_page.search_time)
+            if not partial:
+                self.result_cache.put(key, result_page)
+        else:
+            logger.info("\tServed from result cache")
+            result_page = ResultPage(result_page.hits, page, pagelen, result_page.total)
+        return result_page
+
+    def cursor(self, query, pagelen=10, ranking=CUSTOM, fields=None, profile_name=None):
+        """Returns a ResultCursor for paging through the results of query."""
+        return ResultCursor(self, query, pagelen, ranking, fields, profile_name)
+
+    def search_many(self, queries, rankings, limit=10, workers=None, profile_name=None):
+        """
+        Searches every query with every ranking, on a pool of workers threads sharing the pooled searchers. Every
+        query is only parsed once per query parser.
+        Returns a dictionary of the list of SearchResult (url, score, rank) for every (query, ranking).
+        """
+        logger.info("Received %d search requests: %d queries, rankings: %s", len(queries) * len(rankings),
+                    len(queries), ', '.join(rankings))
+        self.refresh()
+        self._check_request(rankings, profile_name)
+
+        def search(query, ranking):
+            q, _ = self.parse_query(query, ranking, profile_name)
+            hits, _, _ = self._search_hits(q, ranking, 0, limit, ('url',))
+            return (query, ranking), [SearchResult(hit.url, hit.score, hit.rank) for hit in hits]
+
+        args_list = [(query, ranking) for query in queries for ranking in rankings]
+        with ThreadPoolExecutor(max_workers=workers or cpu_count()) as executor:
+            return dict(executor.map(lambda args: search(*args), args_list))
+
+    def _timelimit(self, deadline_ms, start_time):
+        """Returns the time (in seconds) left of the deadline_ms of a search started at start_time, if any."""
+        if deadline_ms is None:
+            return None
+        return deadline_ms / 1000.0 - (time.time() - start_time)
+
+    def _search_hits(self, q, ranking, start, end, fields=None, timelimit=None):
+        """
+        Returns the hits ranked start to end (from 0) of the parsed query q, with the stored fields in fields, the total
+        number of results and whether they are partial (see _search_results).
+        An index split into search shards is searched on all of them at once by the shard search processes, and their
+        top results are merged.
+        """
+        generation, shards, shard_pool = self._index_state
+        if len(shards) == 1:
+            with shards[0].searcher(ranking) as s:
+                results, partial = self._search_results(s, q, end, ranking, timelimit)
+                hits = load_hits(s, results, fields, start, end)
+                # counting all the matches would take the time which has run out
+                total = results.scored_length() if partial else len(results)
+        else:
+            index_dir = get_index_dir(generation)
+            deadline = time.time() + timelimit if timelimit is not None else None
+            async_results = [shard_pool.apply_async(search_shard, (index_dir, shard_no, q, end, ranking, deadline))
+                             for shard_no in range(len(shards))]
+            shard_results = []
+            for shard_no, async_result in enumerate(async_results):
+                try:
+                    timeout = max(deadline + SHARD_SEARCH_GRACE - time.time(), 0) if deadline is not None else None
+                    shard_results.append(async_result.get(timeout))
+                except multiprocessing.TimeoutError:
+                    # a stuck or backlogged worker doesn't hold up the search beyond its deadline
+                    logger.warning("Search shard %d didn't answer in time, its results are left out", shard_no)
+                    shard_results.append(([], 0, True))
+            total = sum(shard_total for _, shard_total, _ in shard_results)
+            partial = any(shard_partial for _, _, shard_partial in shard_results)
+
+            # The top results of every shard are sorted by descending key already
+            top = heapq.merge(*[shard_top for shard_top, _, _ in shard_results], key=itemgetter(0), reverse=True)
+            top = list(itertools.islice(top, start, end))
+            docs = {}
+            for shard_no in set(shard_no for _, shard_no, _, _ in top):
+                docnums = [docnum for _, hit_shard_no, docnum, _ in top if hit_shard_no == shard_no]
+                with shards[shard_no].searcher(ranking) as s:
+                    for docnum, doc_fields in zip(docnums, load_fields(s, docnums, fields)):
+                        docs[(shard_no, docnum)] = doc_fields
+            hits = [Hit(score, start + i, docs[(shard_no, docnum)])
+                    for i, (_, shard_no, docnum, score) in enumerate(top)]
+
+        if timelimit is not None:
+            with self._stats_lock:
+                self.deadline_searches += 1
+                if partial:
+                    self.deadline_exceeded += 1
+        return hits, total, partial
+
+    @staticmethod
+    def _search_results(s, q, limit, ranking, timelimit=None):
+        """
+        Returns the whoosh Results of the top limit documents for the parsed query q, from searcher s, and whether
+        they are partial because the search took longer than timelimit seconds (if not None).
+        """
+        if ranking == SearchEngine.CUSTOM:
+            # The pagerank is blended into the scores by the FusionWeighting while searching, so partial results are
+            # ranked by the blended scores too
+            results, partial = search_top(s, FusionQuery(q), limit, timelimit)
+        else:
+            facet = None
+            reverse = False
+
+            if ranking == SearchEngine.PAGERANK:
+                reverse = True
+                facet = sorting.FieldFacet('pagerank_log')
+                results, partial = collect_results(s, q, s.collector(limit=limit, sortedby=facet, reverse=reverse),
+                                                   timelimit)
             else:
-                facet = None
-                reverse = False
-                q = self.qp.parse(query)
+                # so that the results of a page are the same as those of a search up to that page
+                results, partial = search_top(s, q, limit, timelimit)
+
+        if partial:
+            logger.info("\tOut of time, returning partial results")
+        else:
+            logger.info("\tMatched docs: %d", len(results))
+        logger.info("\tScored docs: %d", results.scored_length())
+        return results, partial
+
+    def deadline_stats(self):
+        """Returns the number of searches given a deadline and of those which ran out of it."""
+        with self._stats_lock:
+            return {'searches': self.deadline_searches, 'exceeded': self.deadline_exceeded}
+
+
+class ShardSearchers(object):
+    """
+    Searchers of all the search shards of the index in index_dir, per ranking, of a shard search process (which is
+    single-threaded, so there is one searcher per shard and ranking). They score with the statistics of the whole
+    corpus (see CorpusStats), so the scores of all shards are comparable.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.ixs = [index.open_dir(shard_dir) for shard_dir in get_shard_dirs(index_dir)]
+        self.corpus_stats = CorpusStats([ix.reader() for ix in self.ixs])
+        self.weightings = dict((ranking, CorpusWeighting(weighting, self.corpus_stats))
+                               for ranking, weighting in SearchEngine.create_weightings().items())
+        self._searchers = {}
+
+    def searcher(self, shard_no, ranking):
+        if (shard_no, ranking) not in self._searchers:
+            self._searchers[(shard_no, ranking)] = self.ixs[shard_no].searcher(weighting=self.weightings[ranking])
+        return self._searchers[(shard_no, ranking)]
+
+    def close(self):
+        for searcher in self._searchers.values():
+            searcher.close()
+        self.corpus_stats.close()
+
+
+def get_shard_pool_context():
+    """
+    Returns the multiprocessing context of the shard search processes. They are started by a fork server (or
+    spawned where there is none) rather than forked, as the search engine may be running threads, e.g. of the search
+    server, which hold locks a forked child would inherit.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+# Searchers of the index generation last searched by this (shard search) process
+_shard_searchers = None
+
+
+def search_shard(index_dir, shard_no, q, limit, ranking, deadline=None):
+    """
+    Searches the search shard shard_no of the index in index_dir, in a shard search process.
+    Returns the top limit results of q as (key, shard_no, docnum, score) sorted by descending key (the score, or the
+    log pagerank for the PAGERANK ranking), the total number of results of the shard and whether they are partial
+    because the search ran until deadline (a time.time(), if not None).
+    """
+    global _shard_searchers
+    if _shard_searchers is None or not _shard_searchers.index_dir == index_dir:
+        if _shard_searchers is not None:
+            _shard_searchers.close()
+        _shard_searchers = ShardSearchers(index_dir)
+    s = _shard_searchers.searcher(shard_no, ranking)
+    timelimit = deadline - time.time() if deadline is not None else None
+    results, partial = SearchEngine._search_results(s, q, limit, ranking, timelimit)
+    docnums = [results.docnum(rank) for rank in range(results.scored_length())]
+    scores = [results.score(rank) for rank in range(results.scored_length())]
+    if ranking == SearchEngine.PAGERANK and docnums:
+        pagerank_log = s.reader().column_reader('pagerank_log')
+        keys = [pagerank_log[docnum] for docnum in docnums]
+    else:
+        keys = scores
+    total = results.scored_length() if partial else len(results)
+    return [(key, shard_no, docnum, score) for key, docnum, score in zip(keys, docnums, scores)], total, partial
+
+
+class ResultPage(object):
+    """
+    A page of search results: the hits, the page number (from 1) and the total number of results, and the time it
+    took to parse the query and to search, in seconds (both 0 if the page came from the result cache). A page is
+    partial if the search ran out of time, its total is then only the number of results found until then.
+    """
+
+    def __init__(self, hits, page, pagelen, total, parse_time=0.0, search_time=0.0, partial=False):
+        self.hits = hits
+        self.page = page
+        self.pagelen = pagelen
+        self.total = total
+        self.parse_time = parse_time
+        self.search_time = search_time
+        self.partial = partial
+
+    @property
+    def offset(self):
+        """Rank (from 0) of the first hit of the page."""
+        return (self.page - 1) * self.pagelen
+
+    @property
+    def pagecount(self):
+        return max(1, (self.total + self.pagelen - 1) // self.pagelen)
+
+    @property
+    def is_last_page(self):
+        return self.page >= self.pagecount
+
+    def __iter__(self):
+        return iter(self.hits)
+
+    def __len__(self):
+        return len(self.hits)
+
+
+class ResultCursor(object):
+    """Pages through the results of a query, fetching every page from the search engine when it is moved to."""
+
+    def __init__(self, search_engine, query, pagelen=10, ranking=SearchEngine.CUSTOM, fields=None, profile_name=None):
+        self.search_engine = search_engine
+        self.query = query
+        self.pagelen = pagelen
+        self.ranking = ranking
+        self.fields = fields
+        self.profile_name = profile_name
+        self.current = self.search_engine.search_page(query, 1, pagelen, ranking, fields, profile_name)
 
-                if ranking == SearchEngine.PAGERANK:
-                    reverse = True
-                    facet = sorting.StoredFieldFacet('pagerank')
+    @property
+    def total(self):
+        return self.current.total
 
-                results = s.search(q, limit=limit, sortedby=facet, reverse=reverse)
+    def move_to(self, page):
+        """Moves to page, clamped to the existing pages, and returns it."""
+        page = min(max(page, 1), self.current.pagecount)
+        if not page == self.current.page:
+            self.current = self.search_engine.search_page(self.query, page, self.pagelen, self.ranking, self.fields,
+                                                          self.profile_name)
+        return self.current
 
-                logger.info("\tMatched docs: %d", len(results))
-                logger.info("\tScored docs: %d", results.scored_length())
+    def next(self):
+        return self.move_to(self.current.page + 1)
 
-                for result in results:
-                    docs.append(Document(**result.fields()))
-        return docs
+    def previous(self):
+        return self.move_to(self.current.page - 1)
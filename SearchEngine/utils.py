@@ -1,11 +1,13 @@
 # coding: utf-8
+import atexit
 import csv
 import os
 import sys
 from functools import wraps
 
 import time
-from multiprocessing import Pool, Manager, cpu_count
+from collections import deque
+from multiprocessing import Pool, cpu_count
 
 
 MSG_START = "[START]"
@@ -112,36 +114,157 @@ def get_files(directory, extension=None):
     return _files
 
 
-def process_batch(args_list, fn, process_no=cpu_count()):
-    total_iterable = len(args_list)
+class WorkerPool(object):
+    """
+    Pool of worker processes which is created once and shared by all the pipeline stages.
+    Tasks are sent to the workers in chunks and progress is reported from the results as they come back.
+    """
 
-    p = Pool(process_no)
-    m = Manager()
-    q = m.Queue()
+    def __init__(self, processes=None, chunksize=None):
+        self.processes = processes or cpu_count()
+        self.chunksize = chunksize
+        self._pool = None
+
+    @property
+    def pool(self):
+        # Workers are only forked once they are needed, so they see any state set up before the first batch
+        if self._pool is None:
+            self._pool = Pool(self.processes)
+        return self._pool
+
+    def get_chunksize(self, total):
+        if self.chunksize:
+            return self.chunksize
+        # Around 4 chunks per worker keeps the workers busy without paying the IPC cost of every single item
+        return max(1, min(1000, total // (self.processes * 4)))
+
+    def imap(self, fn, args_list, chunksize=None):
+        """Yields (index, result) pairs in the order the results are finished."""
+        chunksize = chunksize or self.get_chunksize(len(args_list))
+        return self.pool.imap_unordered(batch_handler, ((fn, i, args) for i, args in enumerate(args_list)), chunksize)
+
+    def imap_bounded(self, fn, args_iterable, max_pending=None, chunksize=None):
+        """
+        Yields fn(*args) for every args in args_iterable, in order.
+        At most max_pending chunks are queued in the pool at a time, so a slow consumer holds back the workers
+        instead of the results piling up in memory.
+        """
+        chunksize = chunksize or self.chunksize or 16
+        max_pending = max_pending or self.processes * 2
+        pending = deque()
+
+        for chunk in iter_chunks(args_iterable, chunksize):
+            if len(pending) >= max_pending:
+                for result in pending.popleft().get():
+                    yield result
+            pending.append(self.pool.apply_async(chunk_handler, ((fn, chunk),)))
+
+        while pending:
+            for result in pending.popleft().get():
+                yield result
+
+    def map(self, fn, args_list, chunksize=None, progress_prefix='Progress:'):
+        """Returns the results of fn(*args) for every args in args_list, in the same order as args_list."""
+        total = len(args_list)
+        results = [None] * total
+        for done, (i, result) in enumerate(self.imap(fn, args_list, chunksize), 1):
+            results[i] = result
+            if progress_prefix and (done == total or done % 100 == 0):
+                print_progress(done, total, progress_prefix)
+        if progress_prefix and not total:
+            print_progress(0, 0, progress_prefix)
+        return results
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+_worker_pool = None
+
+
+def get_worker_pool():
+    """Returns the worker pool shared by all calls of process_batch."""
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = WorkerPool()
+        atexit.register(close_worker_pool)
+    return _worker_pool
+
+
+def configure_worker_pool(processes=None, chunksize=None):
+    """Sets the number of workers and the chunk size of the shared worker pool."""
+    global _worker_pool
+    close_worker_pool()
+    _worker_pool = WorkerPool(processes, chunksize)
+    atexit.register(close_worker_pool)
+    return _worker_pool
+
+
+def close_worker_pool():
+    if _worker_pool is not None:
+        _worker_pool.close()
+
+
+def process_batch(args_list, fn, process_no=None, chunksize=None):
+    if process_no is None:
+        return get_worker_pool().map(fn, args_list, chunksize)
+
+    with WorkerPool(process_no, chunksize) as pool:
+        return pool.map(fn, args_list)
 
-    args = [(fn, q, args) for args in args_list]
 
-    results = p.map_async(batch_handler, args)
-    while (True):
-        # Print progress
-        i = q.qsize()
-        print_progress(i, total_iterable, 'Progress:')
+def batch_handler(args):
+    fn, i, fn_args = args
+    return i, fn(*fn_args)
 
-        if results.ready():
-            break
-        time.sleep(0.2)
 
-    result = results.get()
-    p.close()
-    p.join()
-    return result
+def chunk_handler(args):
+    fn, chunk = args
+    return [fn(*fn_args) for fn_args in chunk]
 
 
-def batch_handler(args):
-    fn, q, fn_args = args
-    result = fn(*fn_args)
-    q.put(True)
-    return result
+def iter_chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class SizedIterable(object):
+    """
+    Wraps an iterable (e.g. a generator) whose number of items is known in advance, so len() can be used on it.
+    Iterating over it again when it wraps a (used up) iterator raises a RuntimeError, instead of silently yielding
+    nothing.
+    """
+
+    def __init__(self, iterable, length):
+        self.iterable = iterable
+        self.length = length
+        self._iterated = False
+
+    def __iter__(self):
+        iterator = iter(self.iterable)
+        if iterator is self.iterable:
+            if self._iterated:
+                raise RuntimeError('The items of this iterable can only be read once')
+            self._iterated = True
+        return iterator
+
+    def __len__(self):
+        return self.length
 
 
 def write_csv(rows, filename, headers=None):